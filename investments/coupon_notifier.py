@@ -10,7 +10,7 @@ from typing import List
 
 from icalendar import Calendar, Event, Alarm
 
-from investments.moex import load_bond
+from investments.moex import load_bonds
 from investments.instruments import CouponScheduleEntry, AmortizationScheduleEntry, Bond
 
 
@@ -107,9 +107,10 @@ def send_to_email(cal: Calendar, bond: Bond, from_addr: str, to_addr: str) -> No
 
 
 def send_payment_schedule_invites(isins: List[str], to_email: str):
-    for isin in isins:
+    print(f"Loading {len(isins)} bond(s)")
+    bonds = load_bonds(isins)
+    for isin, bond in bonds.items():
         print(f"Processing {isin}")
-        bond = load_bond(isin)
         coupons, amorts = bond.payments_since_date(datetime.date.today())
         cal = generate_calendar(bond, coupons, amorts)
         print("Sending email")
@@ -0,0 +1,65 @@
+import datetime
+import hashlib
+import logging
+import os
+import tempfile
+import time
+from typing import Optional
+
+import investments.logsetup
+
+logger = logging.getLogger(__name__)
+
+
+def default_cache_dir(name: str) -> str:
+    """returns per-user cache directory for the application with specified name, following XDG conventions"""
+    cache_home = os.environ.get("XDG_CACHE_HOME")
+    # the spec requires relative paths to be ignored
+    if not cache_home or not os.path.isabs(cache_home):
+        cache_home = os.path.expanduser(os.path.join("~", ".cache"))
+    return os.path.join(cache_home, name)
+
+
+class FileCache:
+    """Persistent cache of text or binary values, one file per key inside specified directory.
+    Can be shared between threads and processes"""
+
+    def __init__(self, directory: str):
+        self.directory = directory
+
+    def __path(self, key: str) -> str:
+        # keys like urls can't be file names, so they are hashed
+        return os.path.join(self.directory, hashlib.blake2b(key.encode("utf-8"), digest_size=16).hexdigest())
+
+    def get(self, key: str, max_age: Optional[datetime.timedelta] = None) -> Optional[str]:
+        """if max_age is set, values saved earlier than max_age ago are treated as missing"""
+        value = self.get_bytes(key, max_age)
+        return value.decode("utf-8") if value is not None else None
+
+    def get_bytes(self, key: str, max_age: Optional[datetime.timedelta] = None) -> Optional[bytes]:
+        try:
+            with open(self.__path(key), "rb") as f:
+                if max_age is not None and time.time() - os.fstat(f.fileno()).st_mtime > max_age.total_seconds():
+                    return None
+                return f.read()
+        except FileNotFoundError:
+            return None
+
+    def put(self, key: str, value: str) -> None:
+        self.put_bytes(key, value.encode("utf-8"))
+
+    def put_bytes(self, key: str, value: bytes) -> None:
+        """failure to save is only logged, as caller can continue without the cache"""
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            # value is written to temporary file and then renamed, so readers never see partially written value
+            fd, tmp_name = tempfile.mkstemp(dir=self.directory)
+            try:
+                with os.fdopen(fd, "wb") as f:
+                    f.write(value)
+                os.replace(tmp_name, self.__path(key))
+            except BaseException:
+                os.remove(tmp_name)
+                raise
+        except OSError as e:
+            logger.warning(f"Cannot save {key} to cache in {self.directory}", exc_info=e)
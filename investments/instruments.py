@@ -1,6 +1,7 @@
 from __future__ import annotations
 
 import datetime
+from bisect import bisect_left
 import os.path
 from dataclasses import dataclass
 import csv
@@ -12,8 +13,22 @@ from investments.utils import find_root_newton
 YEAR_BASE = 365
 
 
+class _FrozenSlots:
+    """base for frozen dataclasses with hand-written __slots__ (dataclass(slots=True) needs python 3.10).
+    Default pickling/copying of slotted objects restores state via setattr, which frozen dataclass forbids"""
+    __slots__ = ()
+
+    def __getstate__(self):
+        return tuple(getattr(self, name) for name in self.__slots__)
+
+    def __setstate__(self, state):
+        for name, value in zip(self.__slots__, state):
+            object.__setattr__(self, name, value)
+
+
 @dataclass(frozen=True)
-class CouponScheduleEntry:
+class CouponScheduleEntry(_FrozenSlots):
+    __slots__ = ("coupon_date", "record_date", "start_date", "value", "yearly_prc")
     coupon_date: datetime.date
     """date of holders fixing. can be missing"""
     record_date: Optional[datetime.date]
@@ -36,9 +51,10 @@ class CouponScheduleEntry:
 
 
 @dataclass(frozen=True)
-class AmortizationScheduleEntry:
+class AmortizationScheduleEntry(_FrozenSlots):
     """date after (!) which notional is amortized. i.e. if coupon fails on amortization date,
     the amount is paid without regard to this amortization, it will be seen only on next coupon"""
+    __slots__ = ("amort_date", "value_prc", "value")
     amort_date: datetime.date
     """Percent of initial notional amortized. in real percents, not in fractions of 1"""
     value_prc: float
@@ -73,6 +89,8 @@ class Bond:
         self.__check_dates_ascending(self.amortizations, lambda e: e.amort_date)
         self.__check_dates_ascending(self.coupons, lambda e: e.coupon_date)
         self.__check_dates_ascending(self.coupons, lambda e: e.start_date)
+        # for binary search of coupons by date. bond is frozen, hence the bypass
+        object.__setattr__(self, "_coupon_dates", [coupon.coupon_date for coupon in self.coupons])
         # check amortization schedule eventually repays notional (i.e. notional repayment at
         # settlement is also treated as amortization and must be present)
         percent_notional_amortized = 0.0
@@ -115,9 +133,10 @@ class Bond:
         """returns coupon or its part accrued on dt (in ccy).
         "Накопленный купонный доход" in Russian. Is paid in addition to bond price when we buy it.
         """
-        idx, closest_coupon = next(filter(lambda c: c[1].coupon_date >= dt, enumerate(self.coupons)), None)
-        if closest_coupon is None:
+        idx = bisect_left(self._coupon_dates, dt)
+        if idx == len(self.coupons):
             return 0
+        closest_coupon = self.coupons[idx]
         eff_notional = self.notional_on_date(dt)
         # why? see attached test RU000A0JWSQ7.xml - coupon for 2018-06-08 has start date 2018-03-12, giving
         # 88 days diff, but the cited coupon value doesn't satisfy it, it's calculated from standard 91 days
@@ -129,7 +148,7 @@ class Bond:
     def payments_since_date(self, dt: datetime.date) -> (List[CouponScheduleEntry], List[AmortizationScheduleEntry]):
         """Returns tuple where first element means coupons expected starting from the passed date (inclusively)
         and second element means the same for notional amortizations"""
-        coupons = [coupon for coupon in self.coupons if coupon.coupon_date >= dt]
+        coupons = self.coupons[bisect_left(self._coupon_dates, dt):]
         amortizations = [amort for amort in self.amortizations if amort.amort_date >= dt]
         return coupons, amortizations
 
@@ -196,6 +215,8 @@ class CashFlows:
         if not any(map(lambda flow: flow.flow < 0.0, flows)):
             raise ValueError("There must be negative flows")
         self.flows = flows
+        # root finders evaluate npv many times, so time offsets of flows are computed once
+        self.__years_since_first = [flow.years_since(flows[0].date) for flow in flows]
 
     def irr(self) -> float:
         """
@@ -212,10 +233,18 @@ class CashFlows:
         of the benefits (positive cash flows).
         https://en.wikipedia.org/wiki/Internal_rate_of_return#Exact_dates_of_cash_flows
         """
-        r0 = 0.0
-        for flow in self.flows[1:]:
-            r0 += flow.flow
-        r0 = (-1.0 / self.flows[0].flow) * r0 - 1.0
+        # initial guess is the total return annualized over the average (weighted by flows) time of getting
+        # money back. for bond-like flows it's close to the root, so Newton needs few iterations
+        total_flow = 0.0
+        weighted_years = 0.0
+        for flow, year_fract in zip(self.flows[1:], self.__years_since_first[1:]):
+            total_flow += flow.flow
+            weighted_years += flow.flow * year_fract
+        growth = (-1.0 / self.flows[0].flow) * total_flow
+        if growth > 0.0 and total_flow != 0.0 and weighted_years / total_flow > 0.0:
+            r0 = growth ** (total_flow / weighted_years) - 1.0
+        else:
+            r0 = growth - 1.0
         irr, _, _ = find_root_newton(f=lambda r: self.npv(r), init_guess=r0,
                                      f_der=lambda r: self.npv_der(r))
         return irr
@@ -224,8 +253,7 @@ class CashFlows:
         """Calculates net present worth of the project at specified interest rate
         (in fractions of 1), assuming the project starts at the date of the first cash flow"""
         res = 0.0
-        for flow in self.flows:
-            year_fract = flow.years_since(self.flows[0].date)
+        for flow, year_fract in zip(self.flows, self.__years_since_first):
             res += flow.flow / (1.0 + rate) ** year_fract
         return res
 
@@ -234,8 +262,7 @@ class CashFlows:
         https://en.wikipedia.org/wiki/Internal_rate_of_return#Exact_dates_of_cash_flows
         """
         res = 0.0
-        for flow in self.flows[1:]:
-            year_fract = flow.years_since(self.flows[0].date)
+        for flow, year_fract in zip(self.flows[1:], self.__years_since_first[1:]):
             res -= flow.flow * year_fract / ((1.0 + rate) ** (year_fract + 1))
         return res
 
@@ -253,7 +280,9 @@ ohlc_fieldnames = [field_date, field_open, field_high, field_low, field_close,
 
 
 @dataclass(frozen=True)
-class OHLC:
+class OHLC(_FrozenSlots):
+    # histories hold thousands of these, slots save ~40% of memory per entry
+    __slots__ = ("date", "open", "high", "low", "close", "num_trades", "volume", "waprice")
     date: datetime.date
     open: float
     high: float
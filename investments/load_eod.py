@@ -1,5 +1,6 @@
 import argparse
 import logging
+from concurrent.futures import ThreadPoolExecutor
 from typing import List
 
 from investments import moex
@@ -8,6 +9,13 @@ import investments.logsetup
 logger = logging.getLogger(__name__)
 
 
+def load_and_save(instr: moex.Instrument, num_page_threads: int) -> None:
+    logger.info(f"Loading OHLC data for {instr}")
+    olhc_series = instr.load_ohlc_table(from_date=None, max_workers=num_page_threads)
+    olhc_series.save_to_csv(f"data/{instr.code}.csv")
+    logger.info(f"Saved OHLC data for {instr}")
+
+
 def main():
     parser = argparse.ArgumentParser(
         description="Downloads EOD OLHC data from Moscow Exchange (MOEX) "
@@ -24,6 +32,10 @@ def main():
     parser.add_argument("--share-codes",
                         help="Security ID's (not ISIN's!) of share instruments on MOEX (e.g. SBMX). ",
                         nargs="+", metavar="SHARE_CODE")
+    parser.add_argument("--num-threads", type=int, default=8,
+                        help="Number of instruments to download simultaneously")
+    parser.add_argument("--num-page-threads", type=int, default=4,
+                        help="Number of history pages of one instrument to download simultaneously")
 
     args = parser.parse_args()
     fx_codes = args.fx_codes
@@ -36,10 +48,10 @@ def main():
     instrums.extend([moex.BondInstrument(isin) for isin in bond_codes])
     instrums.extend([moex.ShareInstrument(secid) for secid in share_codes])
 
-    for instr in instrums:
-        logger.info(f"Loading OHLC data for {instr}")
-        olhc_series = instr.load_ohlc_table(from_date=None)
-        olhc_series.save_to_csv(f"data/{instr.code}.csv")
+    # loading is dominated by waiting for MOEX replies, so overlap downloads of different instruments.
+    # list() is to re-raise exceptions from workers
+    with ThreadPoolExecutor(max_workers=args.num_threads) as executor:
+        list(executor.map(lambda instr: load_and_save(instr, args.num_page_threads), instrums))
 
 
 if __name__ == "__main__":
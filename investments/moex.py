@@ -2,27 +2,60 @@ from __future__ import annotations
 import logging
 import xml.etree.ElementTree as ET
 import datetime
-from typing import Callable, Optional, Dict
+import io
+import itertools
+import os
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Optional, Iterable, Union, BinaryIO, Dict, Sequence
 from abc import ABC, abstractmethod
 import investments.logsetup
 
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import csv
 
+from investments.file_cache import FileCache, default_cache_dir
 from investments.instruments import Bond, AmortizationScheduleEntry, CouponScheduleEntry, OHLC, OHLCSeries, \
     IntradayQuote
 
 ISS_URL = "https://iss.moex.com/iss/"
 logger = logging.getLogger(__name__)
 one_day = datetime.timedelta(days=1)
-http_params = {"timeout": 10}
+# (connect, read) timeouts
+http_params = {"timeout": (5, 30)}
+# ISS xml replies are document/data/rows/row, anchored paths avoid descending into the whole tree.
+# ElementTree compiles path once and caches it
+marketdata_row_path = "./data[@id='marketdata']/rows/row"
+# max number of rows in reply of history requests
+history_page_size = 100
+# full pages of past days of history, which don't change, are kept between runs.
+# can be set to None to neither read nor save them
+history_cache: Optional[FileCache] = FileCache(default_cache_dir(os.path.join("moex", "history")))
+# bond schedules change rarely (e.g. when floating coupon gets fixed), so they are reused between runs for a while.
+# replies are kept undecoded, as their encoding is stated by xml declaration. Can be set to None to disable it
+bond_cache: Optional[FileCache] = FileCache(default_cache_dir(os.path.join("moex", "bondization")))
+bond_cache_max_age = datetime.timedelta(hours=12)
+# shared by all loaders (and threads) to reuse keep-alive connections instead of
+# doing TCP+TLS handshake on every request, which matters for paginated history loading
+http_session = requests.Session()
+http_session.mount("https://", HTTPAdapter(pool_maxsize=32,
+                                           max_retries=Retry(total=3, backoff_factor=0.5,
+                                                             status_forcelist=(429, 502, 503, 504))))
+# ISS compresses csv/xml replies several times. requests asks for it by default too, but it's stated explicitly
+# as streamed history loader relies on compressed reply being transparently decoded by iter_lines()
+http_session.headers["Accept-Encoding"] = "gzip, deflate"
+
+
+def coupon_schedule_url(isin: str) -> str:
+    # Without "limit=unlimited" loads only first 20 coupons!
+    return f"{ISS_URL}securities/{isin}/bondization.xml?iss.meta=off&limit=unlimited"
 
 
-def load_coupon_schedule_xml(isin: str) -> str:
-    # Without "limit=unlimited" loads only first 20 coupons!
-    url = f"{ISS_URL}securities/{isin}/bondization.xml?iss.meta=off&limit=unlimited"
-    data = requests.get(url)
-    return data.text
+def load_coupon_schedule_xml(isin: str) -> bytes:
+    """returns undecoded reply, xml parser decodes it according to its declaration"""
+    data = http_session.get(coupon_schedule_url(isin), **http_params)
+    return data.content
 
 
 def __parse_am_entry(am_entry) -> AmortizationScheduleEntry:
@@ -43,17 +76,42 @@ def __parse_coupon_entry(cp_entry) -> CouponScheduleEntry:
     return CouponScheduleEntry(cp_date, rec_date, st_date, val, yearly_prc)
 
 
-def parse_coupon_schedule_xml(data: str) -> Bond:
-    root = ET.fromstring(data)
-    first_row = next(root.iter("row"))
-    isin = first_row.get("isin")
-    name = first_row.get("name")
-    # note: reply rows contain "facevalue" but it's incorrect, it's "current facevalue"
-    initial_notional = float(first_row.get("initialfacevalue"))
-    notional_ccy = first_row.get("faceunit")
-
-    am_schedule = [__parse_am_entry(am_entry) for am_entry in root.findall(".//data[@id='amortizations']//row")]
-    cp_schedule = [__parse_coupon_entry(cp_entry) for cp_entry in root.findall(".//data[@id='coupons']//row")]
+def parse_coupon_schedule_xml(data: Union[str, bytes, BinaryIO]) -> Bond:
+    """data is either the whole reply or binary stream of it (then it's parsed as it arrives)"""
+    if isinstance(data, str):
+        source = io.StringIO(data)
+    elif isinstance(data, bytes):
+        source = io.BytesIO(data)
+    else:
+        source = data
+    isin = None
+    name = None
+    initial_notional = None
+    notional_ccy = None
+    am_schedule = []
+    cp_schedule = []
+    section = None
+    # single pass over the reply, attributes of each row are dropped as soon as it's parsed
+    # and emptied rows are dropped at the end of their section, so the tree doesn't grow with the reply.
+    # reply text itself is held in memory unless it's passed as a stream (load_bond passes it whole, as it caches it)
+    for event, elem in ET.iterparse(source, events=("start", "end")):
+        if event == "start":
+            if elem.tag == "data":
+                section = elem.get("id")
+        elif elem.tag == "row":
+            if isin is None:
+                isin = elem.get("isin")
+                name = elem.get("name")
+                # note: reply rows contain "facevalue" but it's incorrect, it's "current facevalue"
+                initial_notional = float(elem.get("initialfacevalue"))
+                notional_ccy = elem.get("faceunit")
+            if section == "amortizations":
+                am_schedule.append(__parse_am_entry(elem))
+            elif section == "coupons":
+                cp_schedule.append(__parse_coupon_entry(elem))
+            elem.clear()
+        elif elem.tag == "rows":
+            elem.clear()
 
     return Bond(isin=isin, name=name, initial_notional=initial_notional, notional_ccy=notional_ccy,
                 coupons=cp_schedule, amortizations=am_schedule)
@@ -61,11 +119,45 @@ def parse_coupon_schedule_xml(data: str) -> Bond:
 
 # TODO: also make Bond instrument below?
 def load_bond(isin: str) -> Bond:
-    xml = load_coupon_schedule_xml(isin)
-    return parse_coupon_schedule_xml(xml)
+    url = coupon_schedule_url(isin)
+    if bond_cache is not None:
+        cached_reply = bond_cache.get_bytes(url, max_age=bond_cache_max_age)
+        if cached_reply is not None:
+            return parse_coupon_schedule_xml(cached_reply)
+    reply = load_coupon_schedule_xml(isin)
+    bond = parse_coupon_schedule_xml(reply)
+    # saved only after it's parsed, so broken replies are not reused
+    if bond_cache is not None:
+        bond_cache.put_bytes(url, reply)
+    return bond
+
+
+def load_bonds(isins: Iterable[str], max_workers: int = 8) -> Dict[str, Bond]:
+    """loads several bonds at once, returning them keyed by isin in the order of passed isins.
+    ISS has no endpoint returning schedules of several bonds, so they are requested concurrently instead"""
+    isins = list(dict.fromkeys(isins))
+    if len(isins) <= 1:
+        return {isin: load_bond(isin) for isin in isins}
+    with ThreadPoolExecutor(max_workers=min(max_workers, len(isins))) as executor:
+        return dict(zip(isins, executor.map(load_bond, isins)))
+
+
+def is_settled_history_page(lines: Sequence[str], today: datetime.date) -> bool:
+    """lines are of csv reply of history request (started with table name, empty line and header).
+    Page won't change anymore if it's full, so new rows go to next pages, and its last day is over,
+    as rows of running session change until it's closed"""
+    rows = [line for line in lines[3:] if line != ""]
+    if len(rows) < history_page_size:
+        return False
+    date_idx = lines[2].split(";").index("TRADEDATE")
+    last_date = datetime.date.fromisoformat(rows[-1].split(";")[date_idx])
+    # trade dates are in Moscow time, which can be a day ahead of local one
+    return last_date < today - one_day
 
 
 class Instrument(ABC):
+    __slots__ = ("code", "name")
+
     def __init__(self, code: str):
         self.code = code
         self.name = None
@@ -84,39 +176,61 @@ class Instrument(ABC):
         """returns 'middle' part for MOEX url's like engines/stock/markets/shares/boards/TQTF"""
         pass
 
-    # NOTE: CANNOT BE PRIVATE - WON'T CALL DERIVED VARIANTS!
-    def parse_volume(self, row: Dict[str, str]) -> float:
-        return float(row["VOLUME"])
-
-    def parse_num_trades(self, row: Dict[str, str]) -> int:
-        return int(row["NUMTRADES"])
-
-    def parse_waprice(self, row: Dict[str, str]) -> float:
-        return float(row["WAPRICE"])
+    # names of columns in MOEX history reply which differ between instrument types,
+    # None means instrument doesn't have such column
+    volume_column: Optional[str] = "VOLUME"
+    num_trades_column: Optional[str] = "NUMTRADES"
+    waprice_column: Optional[str] = "WAPRICE"
 
     def _parse_ohlc_csv(self, reply: str) -> OHLCSeries:
-        lines = reply.split("\n")[2:]
+        return self._parse_ohlc_lines(reply.split("\n"))
+
+    def _parse_ohlc_lines(self, lines: Iterable[str]) -> OHLCSeries:
+        """lines are lines of MOEX csv reply, which is started with table name and empty line"""
+        reader = csv.reader(itertools.islice(lines, 2, None), delimiter=";")
+        header = next(reader, None)
+        if header is None:
+            return OHLCSeries(self.code, [], None)
+        # columns are looked up by name once, rows are accessed by position.
         # note field names in moex reply are OLHC (parsed here), but our native csv
         # (in instruments module) is OHLC as market convention
-        reader = csv.DictReader(lines, delimiter=";")
+        columns = {column: idx for idx, column in enumerate(header)}
+        date_idx = columns["TRADEDATE"]
+        name_idx = columns["SHORTNAME"]
+        open_idx = columns["OPEN"]
+        low_idx = columns["LOW"]
+        high_idx = columns["HIGH"]
+        close_idx = columns["CLOSE"]
+        num_trades_idx = columns[self.num_trades_column] if self.num_trades_column is not None else None
+        volume_idx = columns[self.volume_column] if self.volume_column is not None else None
+        waprice_idx = columns[self.waprice_column] if self.waprice_column is not None else None
         series = []
         name = None
-        for row in reader:
-            try:
-                num_trades = self.parse_num_trades(row)
-                date = datetime.date.fromisoformat(row["TRADEDATE"])
-                if num_trades != 0:
-                    ohlc = OHLC(date=date, open=float(row["OPEN"]),
-                                low=float(row["LOW"]), high=float(row["HIGH"]), close=float(row["CLOSE"]),
-                                num_trades=num_trades, volume=self.parse_volume(row), waprice=self.parse_waprice(row))
-                    series.append(ohlc)
-                else:
-                    # otherwise pandas import will change column type from double to object due to NA presence
-                    logger.info(f"Skipping {date} for {self} as it had no trades")
+        row = None
+        # single guard for the whole loop, failed row is still known from loop variable
+        try:
+            for row in reader:
+                if len(row) == 0:
+                    # reply ends with empty lines
+                    continue
                 if name is None:
-                    name = row["SHORTNAME"]
-            except ValueError as e:
-                raise ValueError(f"Error happened for row {row}", e)
+                    name = row[name_idx]
+                # instruments without trades (indexes) count as traded, otherwise all their rows would be skipped
+                num_trades = int(row[num_trades_idx]) if num_trades_idx is not None else 1
+                if num_trades == 0:
+                    # checked before parsing other fields as they aren't needed for skipped rows.
+                    # otherwise pandas import will change column type from double to object due to NA presence
+                    logger.info(f"Skipping {row[date_idx]} for {self} as it had no trades")
+                    continue
+                ohlc = OHLC(date=datetime.date.fromisoformat(row[date_idx]), open=float(row[open_idx]),
+                            low=float(row[low_idx]), high=float(row[high_idx]), close=float(row[close_idx]),
+                            num_trades=num_trades,
+                            volume=float(row[volume_idx]) if volume_idx is not None else 0.0,
+                            waprice=float(row[waprice_idx]) if waprice_idx is not None else 0.0)
+                series.append(ohlc)
+        except (ValueError, IndexError) as e:
+            # IndexError is for rows truncated before some of the columns
+            raise ValueError(f"Error happened for row {row}", e)
         if self.name is None:
             self.name = name
         return OHLCSeries(self.code, series, name)
@@ -130,26 +244,83 @@ class Instrument(ABC):
         exchange_coords: str = self.get_exchange_coords()
         url = f"{ISS_URL}history/{exchange_coords}/securities/{self.code}/candleborders.csv{fr}"
 
-        # will return not more than 100 entries from the beginning of history
-        reply = requests.get(url, **http_params).text
-        return self._parse_ohlc_csv(reply)
+        today = datetime.date.today()
+        # pages starting from last days can't be settled, so they are always loaded anew
+        use_cache = history_cache is not None and (from_date is None or from_date < today - one_day)
+        if use_cache:
+            cached_reply = history_cache.get(url)
+            if cached_reply is not None:
+                return self._parse_ohlc_csv(cached_reply)
+
+        received_lines = []
+
+        def recorded(lines: Iterable[str]) -> Iterable[str]:
+            for line in lines:
+                received_lines.append(line)
+                yield line
+
+        # will return not more than history_page_size entries from the beginning of history.
+        # reply is parsed while it's being received, without materializing the whole text
+        with http_session.get(url, stream=True, **http_params) as reply:
+            if reply.encoding is None:
+                reply.encoding = "utf-8"
+            series = self._parse_ohlc_lines(recorded(reply.iter_lines(decode_unicode=True)))
+        if use_cache and is_settled_history_page(received_lines, today):
+            history_cache.put(url, "\n".join(received_lines))
+        return series
 
     def load_ohlc_table(self, from_date: Optional[datetime.date] = None,
                         partial_loader: Callable[[Instrument, Optional[datetime.date]], OHLCSeries]
-                        = __load_partial_ohlc_table_csv) -> OHLCSeries:
+                        = __load_partial_ohlc_table_csv, max_workers: int = 1) -> OHLCSeries:
         """loads OHLC table from web API of exchange, starting from the specified date or from beginning if empty.
-        Note for some instruments MOEX API can give data starting from later date than available on their site"""
-        series = OHLCSeries(self.code, [], None)
+        Note for some instruments MOEX API can give data starting from later date than available on their site.
+        If max_workers > 1, along with the page starting right after already loaded data, up to max_workers - 1
+        following pages are loaded in parallel, with their start dates guessed from span of the previous page"""
+        # rows of all pages are collected into one list and series is built (and checked) once in the end
+        rows = []
+        name = None
         date = from_date
-        while True:
-            logger.info(f"Loading {self} from {date if date is not None else 'beginning'}")
-            addition = partial_loader(self, date)
-            if addition.is_empty():
-                break
-            else:
-                series.append(addition)
-                date = addition.ohlc_series[-1].date + datetime.timedelta(days=1)
-        return series
+        guess_step: Optional[datetime.timedelta] = None
+
+        def absorb(page: OHLCSeries) -> bool:
+            """appends rows of page which go after already loaded ones. Returns False if there's nothing more to load,
+            which is known if page is empty and it doesn't start after already loaded rows"""
+            nonlocal date, guess_step, name
+            if page.is_empty():
+                return False
+            new_rows = [ohlc for ohlc in page.ohlc_series if date is None or ohlc.date >= date]
+            if len(new_rows) != 0:
+                rows.extend(new_rows)
+                if page.name is not None:
+                    name = page.name
+                date = new_rows[-1].date + one_day
+                # pages are of fixed number of rows, but their calendar span varies due to holidays,
+                # so guess shorter step to have overlaps (rows are filtered out) rather than gaps (page is reloaded)
+                page_days = (page.ohlc_series[-1].date - page.ohlc_series[0].date).days + 1
+                guess_step = datetime.timedelta(days=max(1, page_days * 4 // 5))
+            return True
+
+        executor = ThreadPoolExecutor(max_workers=max_workers - 1) if max_workers > 1 else None
+        try:
+            while True:
+                logger.info(f"Loading {self} from {date if date is not None else 'beginning'}")
+                guessed_pages = []
+                if executor is not None and date is not None and guess_step is not None:
+                    guessed_dates = [date + k * guess_step for k in range(1, max_workers)]
+                    guessed_pages = [(guessed_date, executor.submit(partial_loader, self, guessed_date))
+                                     for guessed_date in guessed_dates]
+                has_more = absorb(partial_loader(self, date))
+                for guessed_date, guessed_page in guessed_pages:
+                    if not has_more or guessed_date > date:
+                        # in the latter case rows between loaded ones and the guessed date could be missed
+                        guessed_page.cancel()
+                    else:
+                        has_more = absorb(guessed_page.result())
+                if not has_more:
+                    return OHLCSeries(self.code, rows, name)
+        finally:
+            if executor is not None:
+                executor.shutdown()
 
     def update_ohlc_table(self, existing_series: OHLCSeries) -> None:
         """Tries to load new values after the last date of existing series"""
@@ -162,15 +333,15 @@ class Instrument(ABC):
         addition = self.load_ohlc_table(from_date)
         existing_series.append(addition)
 
-    def _parse_intraday_quotes(self, reply: str) -> IntradayQuote:
+    def _parse_intraday_quotes(self, reply: Union[str, bytes]) -> IntradayQuote:
         try:
             root = ET.fromstring(reply)
-            rows = root.findall(".//data[@id='marketdata']//row")
-            if rows is None or len(rows) == 0:
+            # only first row is needed, find() stops the search on it
+            row = root.find(marketdata_row_path)
+            if row is None:
                 now = datetime.datetime.now()
                 delayed_time = (now - datetime.timedelta(minutes=15, microseconds=now.microsecond)).time()
                 return IntradayQuote(instrument=self.code, last=0.0, num_trades=0, is_trading=False, time=delayed_time)
-            row = rows[0]
 
             # TRADINGSTATUS is "T"/"N"
             is_trading = True if row.get("TRADINGSTATUS") == "T" else False
@@ -191,22 +362,25 @@ class Instrument(ABC):
     def load_intraday_quotes(self) -> IntradayQuote:
         exchange_coords = self.get_exchange_coords()
         url = f"{ISS_URL}{exchange_coords}/securities/{self.code}.xml?iss.meta=off"
-        data = requests.get(url, **http_params)
-        return self._parse_intraday_quotes(data.text)
+        data = http_session.get(url, **http_params)
+        # bytes are decoded by xml parser according to xml declaration, which is cheaper than requests' detection
+        return self._parse_intraday_quotes(data.content)
 
 
 class FXInstrument(Instrument):
+    __slots__ = ()
+    volume_column = "VOLRUR"
+
     def __init__(self, secid: str):
         super().__init__(secid)
 
     def get_exchange_coords(self):
         return f"engines/currency/markets/selt/boards/CETS"
 
-    def parse_volume(self, row: Dict[str, str]) -> float:
-        return float(row["VOLRUR"])
-
 
 class BondInstrument(Instrument):
+    __slots__ = ()
+
     def __init__(self, isin: str):
         super().__init__(isin)
 
@@ -215,6 +389,8 @@ class BondInstrument(Instrument):
 
 
 class ShareInstrument(Instrument):
+    __slots__ = ()
+
     def __init__(self, secid: str):
         """Note ISIN's are not supported, only SECID ('Код ценной бумаги' on moex.com)"""
         super().__init__(secid)
@@ -224,6 +400,11 @@ class ShareInstrument(Instrument):
 
 
 class IndexInstrument(Instrument):
+    __slots__ = ()
+    num_trades_column = None
+    volume_column = None
+    waprice_column = None
+
     def __init__(self, secid: str):
         """secid - e.g. MREDC"""
         super().__init__(secid)
@@ -231,16 +412,6 @@ class IndexInstrument(Instrument):
     def get_exchange_coords(self):
         return f"engines/stock/markets/index/boards/RTSI"
 
-    def parse_num_trades(self, row: Dict[str, str]) -> int:
-        # cannot use 0 as otherwise parent loader will skip the row
-        return 1
-
-    def parse_volume(self, row: Dict[str, str]) -> float:
-        return 0.0
-
-    def parse_waprice(self, row: Dict[str, str]) -> float:
-        return 0.0
-
 
 
 
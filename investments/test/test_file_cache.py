@@ -0,0 +1,47 @@
+import datetime
+import os
+import time
+
+from investments.file_cache import FileCache, default_cache_dir
+
+
+class TestFileCache:
+    def test_missing_key(self, tmp_path):
+        cache = FileCache(str(tmp_path))
+        assert cache.get("https://iss.moex.com/iss/a.csv") is None
+
+    def test_can_put_and_get(self, tmp_path):
+        # directory is created on first put
+        cache = FileCache(os.path.join(tmp_path, "not_existing_dir"))
+        cache.put("https://iss.moex.com/iss/a.csv", "history\n\nЦена;1")
+        cache.put("https://iss.moex.com/iss/b.csv", "b")
+        assert cache.get("https://iss.moex.com/iss/a.csv") == "history\n\nЦена;1"
+        assert cache.get("https://iss.moex.com/iss/b.csv") == "b"
+        cache.put("https://iss.moex.com/iss/b.csv", "c")
+        assert cache.get("https://iss.moex.com/iss/b.csv") == "c"
+        # no leftovers of temporary files
+        assert len(os.listdir(os.path.join(tmp_path, "not_existing_dir"))) == 2
+
+    def test_old_values_are_missing_if_max_age_set(self, tmp_path):
+        cache = FileCache(str(tmp_path))
+        cache.put("a", "a")
+        assert cache.get("a", max_age=datetime.timedelta(hours=1)) == "a"
+        hour_and_minute_ago = time.time() - 61 * 60
+        os.utime(os.path.join(tmp_path, os.listdir(tmp_path)[0]), (hour_and_minute_ago, hour_and_minute_ago))
+        assert cache.get("a", max_age=datetime.timedelta(hours=1)) is None
+        assert cache.get("a") == "a"
+
+    def test_keeps_bytes_as_is(self, tmp_path):
+        cache = FileCache(str(tmp_path))
+        value = "<?xml version='1.0' encoding='windows-1251'?><a>Облигация</a>".encode("windows-1251")
+        cache.put_bytes("a", value)
+        assert cache.get_bytes("a") == value
+
+    def test_default_cache_dir_follows_xdg(self, monkeypatch):
+        monkeypatch.setenv("XDG_CACHE_HOME", "/cache_home")
+        assert default_cache_dir("moex") == os.path.join("/cache_home", "moex")
+
+    def test_default_cache_dir_ignores_relative_xdg(self, monkeypatch):
+        monkeypatch.setenv("HOME", "/home/user")
+        monkeypatch.setenv("XDG_CACHE_HOME", "relative_cache_home")
+        assert default_cache_dir("moex") == os.path.join("/home/user", ".cache", "moex")
@@ -1,3 +1,5 @@
+import copy
+import pickle
 from datetime import date, timedelta
 
 from investments.instruments import Bond, AmortizationScheduleEntry, CouponScheduleEntry, YEAR_BASE, OHLC, OHLCSeries, \
@@ -6,6 +8,11 @@ import pytest
 
 
 class TestCouponScheduleEntry:
+    def test_can_copy_and_pickle(self):
+        entry = CouponScheduleEntry(date(2019, 9, 6), None, date(2019, 6, 7), 29.17, 11.7)
+        assert copy.copy(entry) == entry
+        assert pickle.loads(pickle.dumps(entry)) == entry
+
     def test_cannot_put_negative_value(self):
         with pytest.raises(ValueError):
             CouponScheduleEntry(date(2019, 9, 6), date(2019, 9, 5), date(2019, 9, 3),
@@ -110,6 +117,12 @@ class TestBond:
         assert b.accrued_coupon_on_date(coup2_date) == pytest.approx(expected_coupon1)
         assert expected_coupon1 != pytest.approx(expected_coupon1_wrong)
 
+    def test_no_accrued_coupon_after_last_coupon(self):
+        coupons = [CouponScheduleEntry(date(2018, 3, 9), None, date(2017, 12, 8), 29.17, 11.7)]
+        amortizations = [AmortizationScheduleEntry(date(2018, 3, 9), 100.0, 1000.0)]
+        b = Bond(coupons=coupons, amortizations=amortizations)
+        assert b.accrued_coupon_on_date(date(2018, 3, 10)) == 0
+
     def test_payments_since_date(self):
         coup1_start_date = date(2017, 12, 8)
         coup1_date = date(2018, 3, 9)
@@ -169,6 +182,11 @@ class TestOHLC:
         ohlc_parsed = OHLC.from_csv_row(csv_row)
         assert ohlc == ohlc_parsed
 
+    def test_can_copy_and_pickle(self):
+        ohlc = OHLC(date.today(), open=9.0, low=9.0, high=15.0, close=11.0, num_trades=1, volume=10.0, waprice=12.0)
+        assert copy.copy(ohlc) == ohlc
+        assert pickle.loads(pickle.dumps(ohlc)) == ohlc
+
 
 class TestOHLCSeries:
     def test_can_create_empty_series(self):
@@ -297,3 +315,12 @@ class TestCashFlows:
             CashFlow(date(2023, 3, 20), 100.0 * (1 + 2 * 0.1))
         ])
         assert flows.irr() == pytest.approx(0.0954451)
+
+    def test_irr_of_long_bond_like_flows(self):
+        # total return is far from yearly one here, irr must still converge to it
+        flows = [CashFlow(date(2021, 3, 20), -60.0)]
+        flows += [CashFlow(date(2021 + year, 3, 20), 5.0) for year in range(1, 21)]
+        flows.append(CashFlow(date(2041, 3, 20), 100.0))
+        irr = CashFlows(flows).irr()
+        assert CashFlows(flows).npv(irr) == pytest.approx(0.0, abs=1E-8)
+        assert irr == pytest.approx(0.0955, abs=1E-4)
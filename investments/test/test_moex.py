@@ -1,11 +1,13 @@
 from datetime import date, time, datetime, timedelta
+import io
 import os
 from unittest.mock import MagicMock
 
 import pytest
 
 import investments.moex as m
-from investments.instruments import CouponScheduleEntry, AmortizationScheduleEntry, OHLC, OHLCSeries
+from investments.file_cache import FileCache
+from investments.instruments import Bond, CouponScheduleEntry, AmortizationScheduleEntry, OHLC, OHLCSeries
 
 
 class TestMoex:
@@ -57,8 +59,45 @@ class TestMoex:
                 print(coupon)
                 raise
 
-    def test_ytm1(self, sample_bond_xml: str):
-        bond = m.parse_coupon_schedule_xml(sample_bond_xml)
+    def test_can_parse_bond_from_stream(self, sample_bond_xml: str):
+        streamed_bond = m.parse_coupon_schedule_xml(io.BytesIO(sample_bond_xml.encode("utf-8")))
+        assert streamed_bond == m.parse_coupon_schedule_xml(sample_bond_xml)
+
+    def test_can_parse_bond_from_bytes(self, sample_bond_xml: str):
+        bond = m.parse_coupon_schedule_xml(sample_bond_xml.encode("utf-8"))
+        assert bond == m.parse_coupon_schedule_xml(sample_bond_xml)
+        assert bond.name == "Мордовия 34003 обл."
+
+    def test_reuses_bond_reply_in_any_encoding(self, monkeypatch, tmp_path, sample_bond_xml: str):
+        reply = sample_bond_xml.replace('encoding="UTF-8"', 'encoding="windows-1251"').encode("windows-1251")
+        loaded = []
+
+        def load_coupon_schedule_xml(isin: str) -> bytes:
+            loaded.append(isin)
+            return reply
+
+        monkeypatch.setattr(m, "load_coupon_schedule_xml", load_coupon_schedule_xml)
+        monkeypatch.setattr(m, "bond_cache", FileCache(str(tmp_path)))
+        bond = m.load_bond("RU000A0JWSQ7")
+        assert bond.name == "Мордовия 34003 обл."
+        assert m.load_bond("RU000A0JWSQ7") == bond
+        assert loaded == ["RU000A0JWSQ7"]
+
+    def test_load_bonds_keeps_order_of_isins(self, monkeypatch, sample_bond_xml: str):
+        loaded = []
+
+        def load_bond(isin: str):
+            loaded.append(isin)
+            return m.parse_coupon_schedule_xml(sample_bond_xml)
+
+        monkeypatch.setattr(m, "load_bond", load_bond)
+        bonds = m.load_bonds(["B", "A", "C", "A"])
+        assert list(bonds.keys()) == ["B", "A", "C"]
+        assert sorted(loaded) == ["A", "B", "C"]
+        assert bonds["A"].isin == "RU000A0JWSQ7"
+
+    def test_ytm1(self, sample_bond: Bond):
+        bond = sample_bond
         buy_date = date(2020, 7, 28)
         settle_date = date(2020, 7, 29)
         assert bond.notional_on_date(settle_date) == 700.0
@@ -85,8 +124,8 @@ class TestMoex:
         # commission brings further 12 points down
         assert ytm_tax_comm == pytest.approx(0.0444, rel=1E-3)
 
-    def test_ytm2(self, sample_bond_xml: str):
-        bond = m.parse_coupon_schedule_xml(sample_bond_xml)
+    def test_ytm2(self, sample_bond: Bond):
+        bond = sample_bond
         buy_date = date(2020, 8, 10)
         settle_date = date(2020, 8, 11)
         accrued_coupon_moex = 811.62 / 54  # =15.03
@@ -105,8 +144,8 @@ class TestMoex:
                                          coupon_tax_prc=0.13)
         assert ytm_tax == pytest.approx(0.0438, rel=1E-3)
 
-    def test_ytm3(self, sample_bond_xml: str):
-        bond = m.parse_coupon_schedule_xml(sample_bond_xml)
+    def test_ytm3(self, sample_bond: Bond):
+        bond = sample_bond
         buy_date = date(2020, 8, 24)
         settle_date = date(2020, 8, 25)
         accrued_coupon_moex = 781.74 / 43  # =18.18
@@ -126,10 +165,15 @@ class TestMoex:
         assert ytm_tax == pytest.approx(0.0415, rel=1E-3)
 
 
-@pytest.fixture()
+@pytest.fixture(scope="session")
 def sample_bond_xml() -> str:
     with read_file("RU000A0JWSQ7.xml") as f:
-        yield f.read()
+        return f.read()
+
+
+@pytest.fixture(scope="session")
+def sample_bond(sample_bond_xml: str) -> Bond:
+    return m.parse_coupon_schedule_xml(sample_bond_xml)
 
 
 def read_file(rel_name: str):
@@ -179,6 +223,44 @@ class TestInstruments:
         assert ohlc.name == "EURRUB_TOM"
         assert inst.name == ohlc.name
 
+    def test_can_parse_streamed_ohlc_lines(self, sample_ohlc_currency_csv):
+        inst = m.FXInstrument("eurrub")
+        # iter_lines() of streamed reply yields lines without line terminators
+        from_stream: OHLCSeries = inst._parse_ohlc_lines(iter(sample_ohlc_currency_csv.splitlines()))
+        assert from_stream == inst._parse_ohlc_csv(sample_ohlc_currency_csv)
+
+    def test_skips_ohlc_without_trades(self):
+        inst = m.ShareInstrument("SBMX")
+        reply = "history\n\n" \
+                "BOARDID;TRADEDATE;SHORTNAME;SECID;NUMTRADES;VALUE;OPEN;LOW;HIGH;CLOSE;VOLUME;WAPRICE\n" \
+                "TQTF;2020-12-03;SBERBANK MOEX;SBMX;0;0;;;;;0;\n" \
+                "TQTF;2020-12-04;SBERBANK MOEX;SBMX;10;1000;10.0;9.0;11.0;10.5;100;10.2\n\n"
+        ohlc: OHLCSeries = inst._parse_ohlc_csv(reply)
+        assert ohlc.ohlc_series == [OHLC(date(2020, 12, 4), open=10.0, low=9.0, high=11.0, close=10.5, num_trades=10,
+                                         volume=100.0, waprice=10.2)]
+        # name is taken even from skipped row
+        assert ohlc.name == "SBERBANK MOEX"
+
+    def test_reports_ohlc_row_which_cannot_be_parsed(self):
+        inst = m.ShareInstrument("SBMX")
+        reply = "history\n\n" \
+                "BOARDID;TRADEDATE;SHORTNAME;SECID;NUMTRADES;VALUE;OPEN;LOW;HIGH;CLOSE;VOLUME;WAPRICE\n" \
+                "TQTF;2020-12-03;SBERBANK MOEX;SBMX;10;1000;10.0;9.0;11.0;10.5;100;10.2\n" \
+                "TQTF;2020-12-04;SBERBANK MOEX;SBMX;10;1000;10.0;bad;11.0;10.5;100;10.2\n"
+        with pytest.raises(ValueError) as e:
+            inst._parse_ohlc_csv(reply)
+        assert "2020-12-04" in str(e.value)
+
+    def test_reports_truncated_ohlc_row(self):
+        inst = m.ShareInstrument("SBMX")
+        reply = "history\n\n" \
+                "BOARDID;TRADEDATE;SHORTNAME;SECID;NUMTRADES;VALUE;OPEN;LOW;HIGH;CLOSE;VOLUME;WAPRICE\n" \
+                "TQTF;2020-12-03;SBERBANK MOEX;SBMX;10;1000;10.0;9.0;11.0;10.5;100;10.2\n" \
+                "TQTF;2020-12-04;SBERBANK MOEX;SBMX;10;1000;10.0\n"
+        with pytest.raises(ValueError) as e:
+            inst._parse_ohlc_csv(reply)
+        assert "2020-12-04" in str(e.value)
+
     def test_can_parse_index_ohlc(self, sample_ohlc_index_csv):
         inst = m.IndexInstrument("mredc")
         assert inst.name is None
@@ -192,6 +274,63 @@ class TestInstruments:
         assert ohlc.name == "Индекс недвиж-ти ДомКлик Москва"
         assert inst.name == ohlc.name
 
+    @staticmethod
+    def history_page(last_date: date, num_rows: int = m.history_page_size):
+        header = "BOARDID;TRADEDATE;SHORTNAME;SECID;NUMTRADES;VALUE;OPEN;LOW;HIGH;CLOSE;VOLUME;WAPRICE"
+        rows = [f"TQTF;{last_date - timedelta(days=num_rows - 1 - i)};SBERBANK MOEX;SBMX;10;1000;10.0;9.0;11.0;10.5;100;10.2"
+                for i in range(num_rows)]
+        return ["history", "", header] + rows + [""]
+
+    def test_only_full_pages_of_past_days_are_settled(self):
+        today = date(2021, 3, 10)
+        assert m.is_settled_history_page(self.history_page(date(2021, 3, 1)), today)
+        assert not m.is_settled_history_page(self.history_page(today), today)
+        assert not m.is_settled_history_page(self.history_page(date(2021, 3, 1), num_rows=10), today)
+
+    def test_caches_only_settled_history_pages(self, monkeypatch, tmp_path):
+        class Reply:
+            encoding = "utf-8"
+
+            def __init__(self, lines):
+                self.lines = lines
+
+            def __enter__(self):
+                return self
+
+            def __exit__(self, *args):
+                pass
+
+            def iter_lines(self, decode_unicode):
+                return iter(self.lines)
+
+        page = None
+        requested_urls = []
+
+        def get(url, **kwargs):
+            requested_urls.append(url)
+            return Reply(page)
+
+        monkeypatch.setattr(m.http_session, "get", get)
+        monkeypatch.setattr(m, "history_cache", FileCache(str(tmp_path / "history")))
+        instr = m.ShareInstrument("SBMX")
+        load_page = instr._Instrument__load_partial_ohlc_table_csv
+
+        page = self.history_page(date.today() - timedelta(days=10))
+        assert load_page(date(2000, 1, 1)) == load_page(date(2000, 1, 1))
+        assert len(requested_urls) == 1
+
+        # session of today is still running
+        page = self.history_page(date.today())
+        load_page(date(2000, 1, 2))
+        load_page(date(2000, 1, 2))
+        assert len(requested_urls) == 3
+
+        monkeypatch.setattr(m, "history_cache", None)
+        page = self.history_page(date.today() - timedelta(days=10))
+        load_page(date(2000, 1, 3))
+        load_page(date(2000, 1, 3))
+        assert len(requested_urls) == 5
+
     def test_can_load_full_ohlc_from_partials(self):
         instr = m.FXInstrument("i")
         ohlc1 = OHLC(date(2005, 6, 20), open=10.0, low=5.0, high=15.0, close=12.0, num_trades=1,
@@ -207,6 +346,25 @@ class TestInstruments:
         assert not full_table.is_empty()
         assert full_table.ohlc_series == [ohlc1, ohlc2]
 
+    def test_parallel_load_gives_same_ohlc_as_sequential(self):
+        instr = m.FXInstrument("i")
+        # weekdays with long winter holidays, so page spans differ and speculative pages have gaps and overlaps
+        dates = [date(2020, 12, 1) + timedelta(days=i) for i in range(120)]
+        dates = [d for d in dates if d.weekday() < 5 and not date(2021, 1, 1) <= d <= date(2021, 1, 10)]
+        full_history = [OHLC(d, open=10.0, low=5.0, high=15.0, close=12.0, num_trades=1, volume=100.0, waprice=11.0)
+                        for d in dates]
+
+        def page_loader(_, from_date):
+            return OHLCSeries(instr.code, [ohlc for ohlc in full_history
+                                           if from_date is None or ohlc.date >= from_date][:7])
+
+        sequential = instr.load_ohlc_table(None, page_loader)
+        assert sequential.ohlc_series == full_history
+        parallel = instr.load_ohlc_table(None, page_loader, max_workers=4)
+        assert parallel.ohlc_series == full_history
+        parallel_from_date = instr.load_ohlc_table(date(2020, 12, 20), page_loader, max_workers=4)
+        assert parallel_from_date.ohlc_series == [ohlc for ohlc in full_history if ohlc.date >= date(2020, 12, 20)]
+
     def test_can_parse_day_quotes(self, sample_today_rates_xml: str):
         instr = m.FXInstrument("i")
         today_quotes = instr._parse_intraday_quotes(sample_today_rates_xml)
@@ -216,6 +374,11 @@ class TestInstruments:
         assert today_quotes.is_trading is False
         assert today_quotes.time == time(23, 49, 59)
 
+    def test_can_parse_day_quotes_from_bytes(self, sample_today_rates_xml: str):
+        instr = m.FXInstrument("i")
+        today_quotes = instr._parse_intraday_quotes(sample_today_rates_xml.encode("utf-8"))
+        assert today_quotes == instr._parse_intraday_quotes(sample_today_rates_xml)
+
     def test_can_parse_empty_reply_type1(self, sample_empty_quote1_xml: str):
         instr = m.FXInstrument("i")
         today_quotes = instr._parse_intraday_quotes(sample_empty_quote1_xml)
@@ -238,31 +401,31 @@ class TestInstruments:
         assert today_quotes.time == now
 
 
-@pytest.fixture()
+@pytest.fixture(scope="session")
 def sample_ohlc_currency_csv() -> str:
     with read_file("eurrub.csv") as f:
-        yield f.read()
+        return f.read()
 
 
-@pytest.fixture()
+@pytest.fixture(scope="session")
 def sample_ohlc_index_csv() -> str:
     with read_file("mredc.csv") as f:
-        yield f.read()
+        return f.read()
 
 
-@pytest.fixture()
+@pytest.fixture(scope="session")
 def sample_today_rates_xml() -> str:
     with read_file("USD000UTSTOM.xml") as f:
-        yield f.read()
+        return f.read()
 
 
-@pytest.fixture()
+@pytest.fixture(scope="session")
 def sample_empty_quote1_xml() -> str:
     with read_file("empty_quote1.xml") as f:
-        yield f.read()
+        return f.read()
 
 
-@pytest.fixture()
+@pytest.fixture(scope="session")
 def sample_empty_quote2_xml() -> str:
     with read_file("empty_quote2.xml") as f:
-        yield f.read()
+        return f.read()
@@ -17,6 +17,14 @@ class TestMovingAvg:
             assert calc.avg() == expected_avg
 
 
+class TestApproxDerivative:
+    def test_right_derivative_uses_only_right_point(self):
+        # f is linear on the right of 0, so right derivative is exact there, while symmetric one isn't
+        f = lambda x: abs(x)
+        assert approx_derivative_right(f, 0.0, 1E-3) == pytest.approx(1.0)
+        assert approx_derivative_symmetric(f, 0.0, 1E-3) == pytest.approx(0.0)
+
+
 class TestFindRoot:
     def test_simple(self):
         # has only one root 1
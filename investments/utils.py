@@ -14,11 +14,12 @@ class MovingAvgCalculator:
         self.num_inserted = 0
 
     def add(self, elem: float) -> None:
-        val_to_subtract = self.buffer[self.cur_idx]
-        self.buffer[self.cur_idx] = elem
+        cur_idx = self.cur_idx
+        val_to_subtract = self.buffer[cur_idx]
+        self.buffer[cur_idx] = elem
         self.agg_sum -= val_to_subtract
         self.agg_sum += elem
-        self.cur_idx = self.cur_idx + 1 if self.cur_idx != self.window - 1 else 0
+        self.cur_idx = (cur_idx + 1) % self.window
         # 'if' is for protection from overflow which will turn avg to None
         if self.num_inserted < self.window:
             self.num_inserted += 1
@@ -32,7 +33,7 @@ def approx_derivative_symmetric(f: Callable[[float], float], x: float, h: float)
 
 
 def approx_derivative_right(f: Callable[[float], float], x: float, h: float) -> float:
-    return (f(x + h) - f(x - h)) / (2.0 * h)
+    return (f(x + h) - f(x)) / h
 
 
 def find_root_newton(f: Callable[[float], float], init_guess: float, eps: float = 1.0E-10,
@@ -5,6 +5,7 @@ import sys
 from typing import List, MutableMapping, Dict, Mapping, Optional
 import requests
 import re
+import heapq
 import datetime
 import os
 import os.path
@@ -14,7 +15,7 @@ import smtplib
 from dataclasses import dataclass
 from email.mime.text import MIMEText
 
-from bs4 import BeautifulSoup
+from bs4 import BeautifulSoup, SoupStrainer
 
 
 @dataclass(frozen=True)
@@ -37,28 +38,30 @@ class RatesTable:
     def __init__(self, rates_by_dates: MutableMapping[datetime.date, MutableMapping[CcyPair, RatesInfo]]):
         self.by_dates = rates_by_dates
 
-    def append_rates(self, other: RatesTable) -> bool:
-        """Modifies self absorbing new info from the other argument and returns true if
-        there were new data absorbed"""
-        modified = False
+    def __len__(self) -> int:
+        """number of dates having rates, so table is falsy when empty"""
+        return len(self.by_dates)
+
+    def is_empty(self) -> bool:
+        return len(self.by_dates) == 0
+
+    def append_rates(self, other: RatesTable) -> RatesTable:
+        """Modifies self absorbing new info from the other argument and returns table
+        of just the absorbed rates, which is empty if there was no new data"""
+        absorbed = {}
         for date, other_rates_for_date in other.by_dates.items():
-            if date not in self.by_dates:
-                self.by_dates[date] = other_rates_for_date
-                modified = True
-            else:
-                existing_for_date = self.by_dates[date]
-                for ccy_pair, other_rate_for_pair in other_rates_for_date.items():
-                    if ccy_pair not in existing_for_date:
-                        existing_for_date[ccy_pair] = other_rate_for_pair
-                        modified = True
-        return modified
+            existing_for_date = self.by_dates.setdefault(date, {})
+            for ccy_pair, other_rate_for_pair in other_rates_for_date.items():
+                if ccy_pair not in existing_for_date:
+                    existing_for_date[ccy_pair] = other_rate_for_pair
+                    absorbed.setdefault(date, {})[ccy_pair] = other_rate_for_pair
+        return RatesTable(absorbed)
 
     def find_violating_rates(self, rel_eps: float) -> Dict[CcyPair, RatesViolation]:
         """Finds ccy pairs whose rates changed in relative terms more than specified rel_eps
         between last available day and the day before that"""
-        sorted_dates = sorted(self.by_dates.keys())
-        last_date = sorted_dates[-1]
-        prev_date = sorted_dates[-2]
+        # only two latest dates are needed, no need to sort the whole history
+        last_date, prev_date = heapq.nlargest(2, self.by_dates.keys())
         last_rates: MutableMapping[CcyPair, RatesInfo] = self.by_dates[last_date]
         prev_rates: MutableMapping[CcyPair, RatesInfo] = self.by_dates[prev_date]
         violating_rates: Dict[CcyPair, RatesViolation] = {}
@@ -72,18 +75,17 @@ class RatesTable:
         return violating_rates
 
 
+# dates in headers of rates columns, e.g. 04.09.2020
+date_regex = re.compile(r"(\d{2})\.(\d{2})\.(\d{4})")
+
+
 def find_dates(indicators_parent) -> List[datetime.date]:
     indicators_dates = indicators_parent.find("div", class_="home-indicators_titles") \
         .find_all("div", class_="indicator_col-title")
     dates = []
-    date_regex = re.compile(r"(?P<day>\d{2})\.(?P<month>\d{2})\.(?P<year>\d{4})")
     for header_item in indicators_dates:
-        m = date_regex.search(header_item.string)
-        day = m.group("day")
-        month = m.group("month")
-        year = m.group("year")
-        date = datetime.date(int(year), int(month), int(day))
-        dates.append(date)
+        day, month, year = date_regex.search(header_item.string).groups()
+        dates.append(datetime.date(int(year), int(month), int(day)))
     return dates
 
 
@@ -101,6 +103,8 @@ def find_ccy_pair(course_item) -> CcyPair:
 
 def find_rates(dates: List[datetime.date], indicators_parent) -> RatesTable:
     rates_by_dates = {}
+    # all rates are scraped at the same moment
+    ts = datetime.datetime.now()
     indicators_courses = indicators_parent.find_all("div", class_="indicator_course")
     for course_item in indicators_courses:
         ccy_pair = find_ccy_pair(course_item)
@@ -110,23 +114,33 @@ def find_rates(dates: List[datetime.date], indicators_parent) -> RatesTable:
             rate = rate_node.contents[0].string
             rate = float(rate.replace(",", "."))
             date = dates[idx_date]
-            if date in rates_by_dates:
-                for_date = rates_by_dates[date]
-            else:
-                for_date = {}
-                rates_by_dates[date] = for_date
-            for_date[ccy_pair] = RatesInfo(rate=rate, ts=datetime.datetime.now())
+            for_date = rates_by_dates.setdefault(date, {})
+            for_date[ccy_pair] = RatesInfo(rate=rate, ts=ts)
             idx_date += 1
     return RatesTable(rates_by_dates)
 
 
+def is_indicators_class(css_class) -> bool:
+    # while parsing, class attribute is not yet split into list of classes
+    if css_class is None:
+        return False
+    return "indicators" in (css_class.split() if isinstance(css_class, str) else css_class)
+
+
+# rates are only in this block, so the rest of the page is not built into the tree
+indicators_strainer = SoupStrainer("div", class_=is_indicators_class)
+
+
 def download_fresh_rates_by_dates(cbr_html, html_dump_filename: Optional[str]) -> RatesTable:
-    soup = BeautifulSoup(cbr_html, 'html.parser')
-    # encoding needed for saving of rouble sign
     if html_dump_filename:
-        with open(html_dump_filename, 'w', encoding='utf-8') as html_file:
+        if hasattr(cbr_html, "read"):
+            cbr_html = cbr_html.read()
+        # page is saved as it was received, prettifying it would need the whole page parsed into tree
+        with open(html_dump_filename, 'wb') as html_file:
             print(f'Dumping to {html_dump_filename}')
-            html_file.write(soup.prettify())
+            # encoding needed for saving of rouble sign
+            html_file.write(cbr_html.encode('utf-8') if isinstance(cbr_html, str) else cbr_html)
+    soup = BeautifulSoup(cbr_html, 'html.parser', parse_only=indicators_strainer)
     indicators_parent = soup.find("div", class_="indicators")
     dates = find_dates(indicators_parent)
     return find_rates(dates, indicators_parent)
@@ -142,21 +156,18 @@ def load_existing_rates(filename: str) -> RatesTable:
                 ccy_pair = line[1]
                 rate = float(line[2])
                 ts = datetime.datetime.fromisoformat(line[3])
-                if date not in rates_by_dates:
-                    for_date = {}
-                    rates_by_dates[date] = for_date
-                else:
-                    for_date = rates_by_dates[date]
+                for_date = rates_by_dates.setdefault(date, {})
                 for_date[ccy_pair] = RatesInfo(rate, ts)
     return RatesTable(rates_by_dates)
 
 
-def save_rates(rates_table: RatesTable, filename: str) -> None:
-    with open(filename, 'w', newline='') as f:
+def save_rates(rates_table: RatesTable, filename: str, append: bool = False) -> None:
+    """if append is set, rates are added to the end of the file instead of replacing its contents"""
+    with open(filename, 'a' if append else 'w', newline='') as f:
         csv_writer = csv.writer(f)
-        for date, rates_for_date in rates_table.by_dates.items():
-            for ccy_pair, rates in rates_for_date.items():
-                csv_writer.writerow((date, ccy_pair, rates.rate, rates.ts))
+        csv_writer.writerows((date, ccy_pair, rates.rate, rates.ts)
+                             for date, rates_for_date in rates_table.by_dates.items()
+                             for ccy_pair, rates in rates_for_date.items())
 
 
 def send_mail(email_address: str, msg_header: str, msg_text: str) -> None:
@@ -172,9 +183,9 @@ def send_mail(email_address: str, msg_header: str, msg_text: str) -> None:
 def prepare_mail_text(violating_rates: Mapping[CcyPair, RatesViolation], rel_eps: float) -> (str, str):
     if len(violating_rates) != 0:
         header = f"WARN: {', '.join(violating_rates.keys())} rate jump"
-        msg = f"The following rates jumped by more than {rel_eps * 100.0}%:\n"
-        for ccy_pair, viol in violating_rates.items():
-            msg += f"{ccy_pair}: {viol.rate_yesterday} -> {viol.rate_now} (rel.diff={100.0 * viol.rel_diff}%)\n"
+        msg = f"The following rates jumped by more than {rel_eps * 100.0}%:\n" + \
+              "".join(f"{ccy_pair}: {viol.rate_yesterday} -> {viol.rate_now} (rel.diff={100.0 * viol.rel_diff}%)\n"
+                      for ccy_pair, viol in violating_rates.items())
     else:
         header = f"All rates jumped less than {rel_eps * 100.0}%\n"
         msg = ""
@@ -210,12 +221,16 @@ def main() -> None:
     rates_by_dates_existing = load_existing_rates(rates_history_filename)
 
     print(f"Downloading new rates from {url}")
-    page = requests.get(url)
+    # (connect, read) timeouts, so that a stalled cbr.ru doesn't hang the scheduled run
+    page = requests.get(url, timeout=(5, 30))
+    page.raise_for_status()
     rates_by_dates_delta = download_fresh_rates_by_dates(page.content, html_dump_filename)
 
-    if rates_by_dates_existing.append_rates(rates_by_dates_delta):
+    new_rates = rates_by_dates_existing.append_rates(rates_by_dates_delta)
+    if not new_rates.is_empty():
         print(f"Saving new rates to {rates_history_filename}")
-        save_rates(rates_by_dates_existing, rates_history_filename)
+        # history is only growing, so just new rows are written
+        save_rates(new_rates, rates_history_filename, append=True)
         violating_rates = rates_by_dates_existing.find_violating_rates(rel_eps)
         header, msg = prepare_mail_text(violating_rates, rel_eps)
         if msg != "":
@@ -4,7 +4,7 @@ from datetime import date, datetime, timedelta
 import pytest
 
 from scrapers.parse_cbr import RatesInfo, download_fresh_rates_by_dates
-from scrapers.parse_cbr import RatesTable
+from scrapers.parse_cbr import RatesTable, RatesViolation, prepare_mail_text, save_rates, load_existing_rates
 
 
 class TestRatesInfo:
@@ -43,6 +43,27 @@ class TestRatesTable:
         assert d["EURRUB"].rate == 80
         assert d["USDRUB"].rate == 75
 
+    def test_append_rates_returns_absorbed_rates(self):
+        eur = RatesInfo(80, datetime.now())
+        usd = RatesInfo(75, datetime.now())
+        subj = RatesTable({date(2020, 7, 14): {"EURRUB": eur}})
+        absorbed = subj.append_rates(RatesTable({date(2020, 7, 14): {"EURRUB": eur, "USDRUB": usd},
+                                                 date(2020, 7, 15): {"EURRUB": eur}}))
+        assert absorbed.by_dates == {date(2020, 7, 14): {"USDRUB": usd}, date(2020, 7, 15): {"EURRUB": eur}}
+        assert subj.append_rates(absorbed).is_empty()
+        # as with former boolean result, it's truthy only if something changed
+        assert absorbed
+        assert not subj.append_rates(absorbed)
+
+    def test_saved_rates_can_be_appended(self, tmp_path):
+        filename = os.path.join(tmp_path, "rates.csv")
+        ts = datetime(2020, 7, 14, 12, 30)
+        save_rates(RatesTable({date(2020, 7, 14): {"EURRUB": RatesInfo(80.5, ts)}}), filename)
+        save_rates(RatesTable({date(2020, 7, 15): {"EURRUB": RatesInfo(81.5, ts)}}), filename, append=True)
+        loaded = load_existing_rates(filename)
+        assert loaded.by_dates == {date(2020, 7, 14): {"EURRUB": RatesInfo(80.5, ts)},
+                                   date(2020, 7, 15): {"EURRUB": RatesInfo(81.5, ts)}}
+
     def test_find_violating_rates(self):
         d1 = date(2020, 7, 14)
         d2 = date(2020, 7, 15)
@@ -63,6 +84,17 @@ class TestRatesTable:
         assert "USDRUB" not in viols
 
 
+def test_prepare_mail_text():
+    header, msg = prepare_mail_text({"USDRUB": RatesViolation(75.0, 70.0, 0.5),
+                                     "EURRUB": RatesViolation(90.0, 80.0, 0.25)}, 0.01)
+    assert header == "WARN: USDRUB, EURRUB rate jump"
+    assert msg == "The following rates jumped by more than 1.0%:\n" \
+                  "USDRUB: 70.0 -> 75.0 (rel.diff=50.0%)\n" \
+                  "EURRUB: 80.0 -> 90.0 (rel.diff=25.0%)\n"
+    header, msg = prepare_mail_text({}, 0.01)
+    assert msg == ""
+
+
 def test_can_parse_html(html_dump):
     rates_table = download_fresh_rates_by_dates(html_dump, None)
     assert set(rates_table.by_dates.keys()) == {date(2020, 9, 4), date(2020, 9, 5)}
@@ -76,6 +108,15 @@ def test_can_parse_html(html_dump):
     assert d2["USDRUB"].rate == pytest.approx(75.1823)
 
 
+def test_dumps_html_as_is(html_dump, tmp_path):
+    dump_filename = os.path.join(tmp_path, "dump.html")
+    rates_table = download_fresh_rates_by_dates(html_dump, dump_filename)
+    assert len(rates_table.by_dates) == 2
+    html_dump.seek(0)
+    with open(dump_filename, "r", encoding="utf-8", newline="") as f:
+        assert f.read() == html_dump.read()
+
+
 @pytest.fixture()
 def html_dump():
     fname = os.path.join(os.path.dirname(__file__), "test.html")
@@ -1,3 +1,4 @@
+import errno
 import os
 import shutil
 import logging
@@ -7,29 +8,65 @@ import transfiles.logsetup
 logger = logging.getLogger(__name__)
 
 
+def on_same_device(file: str, trg_dir: str) -> bool:
+    """returns True if file can be moved to trg_dir by renaming, without copying its contents"""
+    # target dir may not exist yet, then the device is that of its closest existing parent
+    trg_dir = os.path.abspath(trg_dir)
+    while not os.path.exists(trg_dir):
+        trg_dir = os.path.dirname(trg_dir)
+    return os.stat(file).st_dev == os.stat(trg_dir).st_dev
+
+
 class FileAction(Action):
+    __slots__ = ("file",)
+
     def __init__(self, file: str):
         self.file = file
 
 
 class MoveAction(FileAction):
+    __slots__ = ("trg_file", "__done_renaming", "__done_moving")
+
     def __init__(self, src_file: str, trg_file: str):
         super().__init__(src_file)
         self.trg_file = trg_file
         self.__done_renaming = None
+        self.__done_moving = False
 
     def __repr__(self) -> str:
         return f"MoveAction[from: {self.file}; to: {self.trg_file}]"
 
     def __eq__(self, other: object) -> bool:
-        if id(self) == id(os):
+        if self is other:
             return True
         if not isinstance(other, MoveAction):
             return False
         else:
             return self.file == other.file and self.trg_file == other.trg_file
 
+    def __hash__(self) -> int:
+        return hash((self.file, self.trg_file))
+
     def pre_commit(self):
+        if os.path.exists(self.trg_file):
+            # otherwise rename/shutil.copyfile() will just silently replace it
+            raise FileExistsError("File {0} already exists".format(self.trg_file))
+        trg_dir = os.path.dirname(self.trg_file)
+        if on_same_device(self.file, trg_dir):
+            # renaming is atomic and doesn't copy contents, and it's reverted by renaming back
+            os.makedirs(trg_dir, exist_ok=True)
+            logger.info(f"Renaming {self.file} to {self.trg_file}")
+            try:
+                os.rename(self.file, self.trg_file)
+                self.__done_moving = True
+                logger.info("Done renaming")
+                return
+            except OSError as e:
+                # e.g. bind mounts of the same filesystem have the same device but can't be renamed between
+                if e.errno != errno.EXDEV:
+                    raise
+                logger.info(f"Cannot rename {self.file} to {self.trg_file} across mount points, will copy it")
+
         tmp_name = self.file + ".bak"
         if os.path.exists(tmp_name):
             raise FileExistsError(f"Cannot rename as {tmp_name} already exists")
@@ -39,21 +76,23 @@ class MoveAction(FileAction):
         logger.info("Done renaming")
 
         logger.info(f"Copying {tmp_name} to {self.trg_file}")
-        if os.path.exists(self.trg_file):
-            # otherwise shutil.copyfile() will just silently replace it
-            raise FileExistsError("File {0} already exists".format(self.trg_file))
-        os.makedirs(os.path.dirname(self.trg_file), exist_ok=True)
+        os.makedirs(trg_dir, exist_ok=True)
         shutil.copyfile(tmp_name, self.trg_file)
         logger.info("Done copying")
 
     def commit(self):
+        if self.__done_moving:
+            return
         src_file, tmp_renamed_file = self.__done_renaming
         logger.info(f"Removing {tmp_renamed_file}")
         os.remove(tmp_renamed_file)
         logger.info("Done removing")
 
     def rollback(self):
-        if self.__done_renaming:
+        if self.__done_moving:
+            logger.info(f"Renaming {self.trg_file} back to {self.file}")
+            os.rename(self.trg_file, self.file)
+        elif self.__done_renaming:
             src_file, tmp_renamed_file = self.__done_renaming
             logger.info(f"Renaming {tmp_renamed_file} to {src_file}")
             os.rename(tmp_renamed_file, src_file)
@@ -65,18 +104,26 @@ class MoveAction(FileAction):
 
 
 class CopyAction(FileAction):
+    __slots__ = ("trg_file", "__created_trg")
+
     def __init__(self, src_file, trg_file):
         super().__init__(src_file)
         self.trg_file = trg_file
+        self.__created_trg = False
 
     def __repr__(self) -> str:
         return f"CopyAction[from: {self.file}; to: {self.trg_file}]"
 
     def pre_commit(self):
-        if os.path.exists(self.trg_file):
-            raise FileExistsError(f"Cannot copy as {self.trg_file} already exists")
         logger.info(f"Copying {self.file} to {self.trg_file}")
         os.makedirs(os.path.dirname(self.trg_file), exist_ok=True)
+        # target is created exclusively, so checking it doesn't exist and creating it is one syscall
+        # and no other file can appear there in between
+        try:
+            os.close(os.open(self.trg_file, os.O_WRONLY | os.O_CREAT | os.O_EXCL))
+        except FileExistsError:
+            raise FileExistsError(f"Cannot copy as {self.trg_file} already exists") from None
+        self.__created_trg = True
         shutil.copyfile(self.file, self.trg_file)
         logger.info("Done copying")
 
@@ -84,6 +131,9 @@ class CopyAction(FileAction):
         pass
 
     def rollback(self):
+        if not self.__created_trg:
+            # e.g. target existed before, it's not ours to remove
+            return
         try:
             logger.info(f"Removing {self.trg_file}")
             os.remove(self.trg_file)
@@ -1,18 +1,25 @@
+import collections
+import contextlib
 import datetime
+import dbm
 import os
-from typing import Sequence
+import shelve
+import struct
+import threading
+from typing import Sequence, Optional
 import argparse
 import logging
+from concurrent.futures import Executor, ThreadPoolExecutor
 
 import piexif
 
-from transfiles import utils
 from transfiles.actions import MoveAction, CopyAction
 from transfiles.transactions import process_actions_atomically, Action
 from transfiles.utils import get_fname_wo_extension
 import transfiles.logsetup
 
 raw_extensions = {"nef", "dng"}
+raw_suffixes = tuple("." + ext for ext in raw_extensions)
 logger = logging.getLogger(__name__)
 
 
@@ -21,24 +28,41 @@ class FolderActionsGenerator:
         raise NotImplementedError
 
 
+def is_raw_file(fname: str) -> bool:
+    return fname.lower().endswith(raw_suffixes)
+
+
 def err_processor(exception: OSError):
     logger.error("Skipping traversing file {0} due to error".format(exception.filename), exc_info=exception)
 
 
+def walk(path):
+    """os.walk() yielding the same (root, dirs, files), but done via os.fwalk() where available,
+    as it lists directories relative to open descriptors and is faster on large trees"""
+    if hasattr(os, "fwalk"):
+        for root, dirs, files, _ in os.fwalk(path, onerror=err_processor):
+            yield root, dirs, files
+    else:
+        yield from os.walk(path, onerror=err_processor)
+
+
 def process_tree(path_to_process, *,
                  generator: FolderActionsGenerator,
                  process_actions=process_actions_atomically):
     if not os.path.isdir(path_to_process):
         raise NotADirectoryError(f"path {path_to_process} is not a directory")
     actions = []
-    for root, dirs, files in os.walk(path_to_process, onerror=err_processor):
+    for root, dirs, files in walk(path_to_process):
         print(f'Collecting actions for directory {root}:')
         actions_for_dir = generator.generate(root, dirs, files)
         actions.extend(actions_for_dir)
     if len(actions) == 0:
         print("No actions to perform")
         return
-    print("Going to process actions:\n", "\n".join(map(repr, actions)), sep="")
+    print("Going to process actions:")
+    # printed one by one, as on large imports joined text would be big and take long to build
+    for action in actions:
+        print(repr(action))
     answer = input("Proceed (Y/N)?")
     if answer.lower() == "y":
         print("Processing:")
@@ -48,7 +72,11 @@ def process_tree(path_to_process, *,
 
 def parse_exif_date(binary_str_datetime) -> datetime.datetime:
     """parses exif date time in binary ascii string in format b'2020:03:22 15:35:59'"""
-    # str_dt = binary_str_datetime.decode("utf-8")
+    b = binary_str_datetime
+    if len(b) == 19 and b[4:5] == b[7:8] == b[13:14] == b[16:17] == b":" and b[10:11] == b" ":
+        # layout is fixed, so slicing is much cheaper than interpreting format by strptime
+        return datetime.datetime(int(b[0:4]), int(b[5:7]), int(b[8:10]),
+                                 int(b[11:13]), int(b[14:16]), int(b[17:19]))
     str_dt = str(binary_str_datetime, encoding="utf-8")
     return datetime.datetime.strptime(str_dt, "%Y:%m:%d %H:%M:%S")
 
@@ -59,46 +87,167 @@ def find_date_taken_from_exif(abs_raw_file: str) -> datetime.datetime:
     return parse_exif_date(str_date_taken)
 
 
+tag_exif_ifd_pointer = 0x8769
+tag_date_time_original = 0x9003
+type_ascii = 2
+# "YYYY:MM:DD HH:MM:SS" with terminating NUL
+date_time_length = 20
+# (ifd entry count, ifd entry: tag, type, count, value/offset, offset) per TIFF byte order
+tiff_structs = {
+    b"II": (struct.Struct("<H"), struct.Struct("<HHI4s"), struct.Struct("<I")),
+    b"MM": (struct.Struct(">H"), struct.Struct(">HHI4s"), struct.Struct(">I")),
+}
+
+
+def read_date_time_original(abs_raw_file: str) -> Optional[bytes]:
+    """reads DateTimeOriginal of tiff-based file (NEF, DNG, ...) by walking only IFD0 and Exif IFD,
+    without parsing the rest of EXIF. Returns None if the tag is not stored as a usual date string"""
+    with open(abs_raw_file, "rb") as f:
+        header = f.read(8)
+        structs = tiff_structs.get(header[:2])
+        if structs is None or len(header) < 8:
+            raise ValueError(f"{abs_raw_file} is not a TIFF file")
+        count_struct, entry_struct, offset_struct = structs
+        if count_struct.unpack_from(header, 2)[0] != 42:
+            raise ValueError(f"{abs_raw_file} is not a TIFF file")
+
+        def find_entry(ifd_offset: int, tag_to_find: int):
+            f.seek(ifd_offset)
+            num_entries, = count_struct.unpack(f.read(2))
+            ifd = f.read(num_entries * entry_struct.size)
+            for tag, typ, count, value in entry_struct.iter_unpack(ifd):
+                if tag == tag_to_find:
+                    return typ, count, value
+            raise KeyError(f"Tag {tag_to_find:#x} is not found in {abs_raw_file}")
+
+        _, _, exif_ifd_pointer = find_entry(offset_struct.unpack_from(header, 4)[0], tag_exif_ifd_pointer)
+        typ, count, value = find_entry(offset_struct.unpack(exif_ifd_pointer)[0], tag_date_time_original)
+        if typ != type_ascii or count < date_time_length:
+            # e.g. values up to 4 bytes are stored right in the entry instead of its offset
+            return None
+        # ascii value of 20 bytes doesn't fit into entry, so it holds offset of the value
+        f.seek(offset_struct.unpack(value)[0])
+        return f.read(count).rstrip(b"\x00")
+
+
+def find_date_taken_fast(abs_raw_file: str) -> datetime.datetime:
+    try:
+        str_date_taken = read_date_time_original(abs_raw_file)
+        if str_date_taken is not None:
+            return parse_exif_date(str_date_taken)
+        logger.debug(f"Date taken of {abs_raw_file} is stored unusually, falling back to piexif")
+    except Exception as e:
+        logger.debug(f"Cannot read date taken from {abs_raw_file} directly, falling back to piexif", exc_info=e)
+    return find_date_taken_from_exif(abs_raw_file)
+
+
+def default_exif_dates_db() -> str:
+    """returns path of dates cache in per-user cache directory, following XDG conventions"""
+    cache_home = os.environ.get("XDG_CACHE_HOME")
+    # the spec requires relative paths to be ignored
+    if not cache_home or not os.path.isabs(cache_home):
+        cache_home = os.path.expanduser(os.path.join("~", ".cache"))
+    return os.path.join(cache_home, "transfiles", "exif_dates.db")
+
+
+class CachedDateTaken:
+    """Wraps find_date_taken function, persisting found dates so that reruns on the same files
+    don't read them again. File is looked up by its path, modification time and size, so changed file
+    is read anew. Can be called from several threads"""
+
+    def __init__(self, find_date_taken, db_path: str):
+        self.find_date_taken = find_date_taken
+        os.makedirs(os.path.dirname(db_path), exist_ok=True)
+        self.__db = shelve.open(db_path)
+        self.__lock = threading.Lock()
+
+    def __call__(self, abs_raw_file: str) -> datetime.datetime:
+        st = os.stat(abs_raw_file)
+        key = f"{os.path.abspath(abs_raw_file)}|{st.st_mtime_ns}|{st.st_size}"
+        with self.__lock:
+            cached = self.__db.get(key)
+        if cached is not None:
+            return datetime.datetime.fromisoformat(cached)
+        date_taken = self.find_date_taken(abs_raw_file)
+        with self.__lock:
+            self.__db[key] = date_taken.isoformat()
+        return date_taken
+
+    def close(self):
+        self.__db.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
 class ImportRawsActionsGenerator(FolderActionsGenerator):
-    def __init__(self, target_dir, find_date_taken=find_date_taken_from_exif,
-                 delete_src=False):
+    def __init__(self, target_dir, find_date_taken=find_date_taken_fast,
+                 delete_src=False, executor: Optional[Executor] = None):
+        """if executor is passed, dates are read from files of a directory in parallel on it"""
         self.target_dir = target_dir
         self.find_date_taken = find_date_taken
         self.delete_src = delete_src
+        self.executor = executor
+        self.__action_cls = MoveAction if delete_src else CopyAction
+
+    def __try_find_date_taken(self, abs_raw_file: str):
+        try:
+            return self.find_date_taken(abs_raw_file)
+        except Exception as e:
+            return e
 
     def generate(self, root, dirs, files) -> Sequence[MoveAction]:
         actions = []
 
         # let's group by filename as there could be several files with common name,
         # e.g raw file itself and its Lightroom sidecar: DSC_8670.NEF and DSC_8670.xmp
-        photos_grouped_by_fname = utils.group_by(files, get_fname_wo_extension)
-        # print(photos_grouped_by_fname)
+        # raw files of each group are found in the same pass
+        photos_grouped_by_fname = collections.defaultdict(list)
+        raw_files_by_fname = collections.defaultdict(list)
+        for file in files:
+            base_fname = get_fname_wo_extension(file)
+            photos_grouped_by_fname[base_fname].append(file)
+            if is_raw_file(file):
+                raw_files_by_fname[base_fname].append(file)
+        groups_with_raw = []
         for base_fname, files_with_fname in photos_grouped_by_fname.items():
             print(f"Processing {base_fname}: {files_with_fname}")
-            is_raw_file = lambda fname: utils.get_extension(fname).lower() in raw_extensions
-            raw_files = list(filter(is_raw_file, files_with_fname))
+            raw_files = raw_files_by_fname.get(base_fname, [])
             num_raw_files_found = len(raw_files)
             if num_raw_files_found == 0:
                 print("Group doesn't have raw file, skipping it:", files_with_fname)
                 continue
             elif num_raw_files_found > 1:
                 print("Group has more than 1 raw file, taking date from first of them: ", raw_files[0])
-            raw_file = raw_files[0]
+            groups_with_raw.append((files_with_fname, raw_files[0]))
 
-            try:
-                date_taken = self.find_date_taken(os.path.join(root, raw_file))
-            except Exception as e:
+        # file names come from directory listing, so they can be just appended to a directory ending with separator,
+        # which is much cheaper than os.path.join() per file
+        root_prefix = os.path.join(root, "")
+        # reading dates is I/O bound, so it's the part worth doing in parallel
+        map_fn = self.executor.map if self.executor is not None else map
+        dates_taken = map_fn(self.__try_find_date_taken,
+                             [root_prefix + raw_file for _, raw_file in groups_with_raw])
+        action_cls = self.__action_cls
+        # most photos of a directory are usually taken on few days, so target dirs are shared
+        trg_prefix_by_date = {}
+        for (files_with_fname, raw_file), date_taken in zip(groups_with_raw, dates_taken):
+            if isinstance(date_taken, Exception):
                 print("Cannot find date taken from EXIF of file {0} due to error {1}. Skipping it"
-                      .format(raw_file, repr(e)))
+                      .format(raw_file, repr(date_taken)))
                 continue
 
-            trg_path = os.path.join(self.target_dir, str(date_taken.year),
-                                    "{0.year}-{0.month:02}-{0.day:02}".format(date_taken))
-            for file in files_with_fname:
-                src = os.path.join(root, file)
-                trg = os.path.join(trg_path, file)
-                action = MoveAction(src, trg) if self.delete_src else CopyAction(src, trg)
-                actions.append(action)
+            day_taken = date_taken.date()
+            trg_prefix = trg_prefix_by_date.get(day_taken)
+            if trg_prefix is None:
+                trg_prefix = os.path.join(self.target_dir, str(day_taken.year),
+                                          "{0.year}-{0.month:02}-{0.day:02}".format(day_taken), "")
+                trg_prefix_by_date[day_taken] = trg_prefix
+            actions.extend(action_cls(root_prefix + file, trg_prefix + file)
+                           for file in files_with_fname)
 
         return actions
 
@@ -113,10 +262,23 @@ def main():
     parser.add_argument("src_dir", help="source directory (with or without trailing slash)")
     parser.add_argument("trg_dir", help="target directory (with or without trailing slash)")
     parser.add_argument("-d", "--delete-src", action="store_true", help="remove source file after successful copying")
+    parser.add_argument("--no-cache", action="store_true",
+                        help="don't use dates taken found on previous runs and don't save found ones")
     args = parser.parse_args()
 
-    dir_actions_generator = ImportRawsActionsGenerator(args.trg_dir, delete_src=args.delete_src)
-    process_tree(args.src_dir, generator=dir_actions_generator)
+    with contextlib.ExitStack() as stack:
+        find_date_taken = find_date_taken_fast
+        if not args.no_cache:
+            try:
+                find_date_taken = stack.enter_context(CachedDateTaken(find_date_taken, default_exif_dates_db()))
+            except (OSError, *dbm.error) as e:
+                # import can go on without the cache, just slower
+                logger.warning("Cannot open cache of dates taken, continuing without it", exc_info=e)
+        # executor is entered last so that it's shut down before the cache is closed
+        executor = stack.enter_context(ThreadPoolExecutor(max_workers=min(32, (os.cpu_count() or 1) * 4)))
+        dir_actions_generator = ImportRawsActionsGenerator(args.trg_dir, find_date_taken,
+                                                           delete_src=args.delete_src, executor=executor)
+        process_tree(args.src_dir, generator=dir_actions_generator)
 
 
 if __name__ == "__main__":
@@ -1,137 +1,186 @@
+import errno
 import os
-import tempfile
 
 import pytest
 
+from transfiles import actions
 from transfiles.actions import MoveAction, CopyAction
 
 
-# TODO: rewrite temp dirs on pytest fixtures
+@pytest.fixture
+def src(tmp_path):
+    src = tmp_path / "src" / "src.txt"
+    src.parent.mkdir()
+    src.write_text("contents")
+    return str(src)
+
 
 class TestMoveAction:
-    def test_can_commit(self):
-        with tempfile.TemporaryDirectory() as trg_dir:
-            src_handle, src = tempfile.mkstemp()
-            # if we don't close it now, Windows will fail to remove/rename it,
-            # because it will be locked by our process. closing it doesn't remove
-            # it so we still have to remove it later.
-            os.close(src_handle)
-            try:
-                assert os.path.exists(src)
-                filename = os.path.basename(src)
-                print("trg_dir=", trg_dir)
-                trg = os.path.join(trg_dir, filename)
-                print("trg=", trg)
-                action = MoveAction(src, trg)
-
-                action.pre_commit()
-                assert not os.path.exists(src)
-                assert os.path.exists(trg)
-                bak_name = os.path.join(os.path.dirname(src), filename + ".bak")
-                assert os.path.exists(bak_name)
-
-                action.commit()
-                assert os.path.exists(trg)
-                assert not os.path.exists(bak_name)
-            finally:
-                if os.path.exists(src):
-                    os.remove(src)
-                    pytest.fail("Didn't cleanup temp src file")
-
-    def test_can_rollback(self):
-        with tempfile.TemporaryDirectory() as trg_dir:
-            src_handle, src = tempfile.mkstemp()
-            os.close(src_handle)
-            try:
-                assert os.path.exists(src)
-                filename = os.path.basename(src)
-                print("trg_dir=", trg_dir)
-                trg = os.path.join(trg_dir, filename)
-                print("trg=", trg)
-                action = MoveAction(src, trg)
-
-                action.pre_commit()
-                assert not os.path.exists(src)
-                assert os.path.exists(trg)
-                bak_name = os.path.join(os.path.dirname(src), filename + ".bak")
-                assert os.path.exists(bak_name)
-
-                action.rollback()
-                assert not os.path.exists(trg)
-                assert not os.path.exists(bak_name)
-                assert os.path.exists(src)
-            finally:
-                os.remove(src)
-
-    def test_can_create_intermediate_folders(self):
-        with tempfile.TemporaryDirectory() as trg_dir_base:
-            # add not existing intermediate dir to ensure it will be created
-            trg_dir = os.path.join(trg_dir_base, "not_existing_dir")
-            src_handle, src = tempfile.mkstemp()
-            os.close(src_handle)
-            try:
-                assert os.path.exists(src)
-                filename = os.path.basename(src)
-                print("trg_dir=", trg_dir)
-                trg = os.path.join(trg_dir, filename)
-                print("trg=", trg)
-                action = MoveAction(src, trg)
-
-                action.pre_commit()
-                assert not os.path.exists(src)
-                assert os.path.exists(trg)
-                bak_name = os.path.join(os.path.dirname(src), filename + ".bak")
-                assert os.path.exists(bak_name)
-
-                action.rollback()
-                assert not os.path.exists(trg)
-                assert not os.path.exists(bak_name)
-                assert os.path.exists(src)
-            finally:
-                os.remove(src)
+    def test_can_commit(self, monkeypatch, tmp_path, src):
+        # temp dirs are usually on the same device, then file would be just renamed
+        monkeypatch.setattr(actions, "on_same_device", lambda file, trg_dir: False)
+        trg = str(tmp_path / "trg" / "src.txt")
+        action = MoveAction(src, trg)
+
+        action.pre_commit()
+        assert not os.path.exists(src)
+        assert os.path.exists(trg)
+        bak_name = src + ".bak"
+        assert os.path.exists(bak_name)
+
+        action.commit()
+        assert os.path.exists(trg)
+        assert not os.path.exists(bak_name)
+        assert not os.path.exists(src)
+
+    def test_can_rollback(self, monkeypatch, tmp_path, src):
+        # temp dirs are usually on the same device, then file would be just renamed
+        monkeypatch.setattr(actions, "on_same_device", lambda file, trg_dir: False)
+        trg_dir = tmp_path / "trg"
+        trg_dir.mkdir()
+        trg = str(trg_dir / "src.txt")
+        action = MoveAction(src, trg)
+
+        action.pre_commit()
+        assert not os.path.exists(src)
+        assert os.path.exists(trg)
+        bak_name = src + ".bak"
+        assert os.path.exists(bak_name)
+
+        action.rollback()
+        assert not os.path.exists(trg)
+        assert not os.path.exists(bak_name)
+        assert os.path.exists(src)
+
+    def test_can_create_intermediate_folders(self, monkeypatch, tmp_path, src):
+        # temp dirs are usually on the same device, then file would be just renamed
+        monkeypatch.setattr(actions, "on_same_device", lambda file, trg_dir: False)
+        # add not existing intermediate dir to ensure it will be created
+        trg = str(tmp_path / "trg" / "not_existing_dir" / "src.txt")
+        action = MoveAction(src, trg)
+
+        action.pre_commit()
+        assert not os.path.exists(src)
+        assert os.path.exists(trg)
+        bak_name = src + ".bak"
+        assert os.path.exists(bak_name)
+
+        action.rollback()
+        assert not os.path.exists(trg)
+        assert not os.path.exists(bak_name)
+        assert os.path.exists(src)
+
+    def test_can_commit_by_renaming(self, tmp_path, src):
+        trg = str(tmp_path / "not_existing_dir" / "trg.txt")
+        action = MoveAction(src, trg)
+
+        action.pre_commit()
+        assert not os.path.exists(src)
+        assert not os.path.exists(src + ".bak")
+        with open(trg) as f:
+            assert f.read() == "contents"
+
+        action.commit()
+        assert not os.path.exists(src)
+        assert os.path.exists(trg)
+
+    def test_can_rollback_renaming(self, tmp_path, src):
+        trg = str(tmp_path / "trg.txt")
+        action = MoveAction(src, trg)
+
+        action.pre_commit()
+        assert not os.path.exists(src)
+        action.rollback()
+        assert not os.path.exists(trg)
+        with open(src) as f:
+            assert f.read() == "contents"
+
+    def test_copies_if_cannot_rename_across_mount_points(self, monkeypatch, tmp_path, src):
+        trg = str(tmp_path / "trg" / "src.txt")
+        rename = os.rename
+
+        def rename_not_to_trg(from_file, to_file):
+            if to_file == trg:
+                raise OSError(errno.EXDEV, "Invalid cross-device link")
+            rename(from_file, to_file)
+
+        monkeypatch.setattr(actions, "on_same_device", lambda file, trg_dir: True)
+        monkeypatch.setattr(os, "rename", rename_not_to_trg)
+        action = MoveAction(src, trg)
+
+        action.pre_commit()
+        assert not os.path.exists(src)
+        assert os.path.exists(src + ".bak")
+        with open(trg) as f:
+            assert f.read() == "contents"
+
+        action.rollback()
+        assert not os.path.exists(trg)
+        assert not os.path.exists(src + ".bak")
+        assert os.path.exists(src)
+
+    def test_does_not_copy_if_rename_fails_otherwise(self, monkeypatch, tmp_path, src):
+        trg = str(tmp_path / "trg" / "src.txt")
+
+        def failing_rename(from_file, to_file):
+            raise PermissionError(errno.EACCES, "Permission denied")
+
+        monkeypatch.setattr(actions, "on_same_device", lambda file, trg_dir: True)
+        monkeypatch.setattr(os, "rename", failing_rename)
+        with pytest.raises(PermissionError):
+            MoveAction(src, trg).pre_commit()
+        assert not os.path.exists(trg)
+
+    def test_does_not_overwrite_target(self, tmp_path, src):
+        trg = tmp_path / "trg.txt"
+        trg.write_text("existing")
+        with pytest.raises(FileExistsError):
+            MoveAction(src, str(trg)).pre_commit()
+        assert os.path.exists(src)
+        assert trg.read_text() == "existing"
+
+    def test_equal_actions_are_deduplicated(self):
+        action = MoveAction("a", "b")
+        assert action == action
+        assert action == MoveAction("a", "b")
+        assert action != MoveAction("a", "c")
+        assert list(dict.fromkeys([action, MoveAction("a", "c"), MoveAction("a", "b")])) == \
+               [action, MoveAction("a", "c")]
 
 
 class TestCopyAction:
-    def test_can_commit(self):
-        with tempfile.TemporaryDirectory() as trg_dir:
-            src_handle, src = tempfile.mkstemp()
-            os.close(src_handle)
-            try:
-                assert os.path.exists(src)
-                filename = os.path.basename(src)
-                print("trg_dir=", trg_dir)
-                trg = os.path.join(trg_dir, filename)
-                print("trg=", trg)
-                action = CopyAction(src, trg)
-
-                action.pre_commit()
-                assert os.path.exists(src)
-                assert os.path.exists(trg)
-
-                action.commit()
-                assert os.path.exists(src)
-                assert os.path.exists(trg)
-            finally:
-                os.remove(src)
-
-    def test_can_rollback(self):
-        with tempfile.TemporaryDirectory() as trg_dir:
-            src_handle, src = tempfile.mkstemp()
-            os.close(src_handle)
-            try:
-                assert os.path.exists(src)
-                filename = os.path.basename(src)
-                print("trg_dir=", trg_dir)
-                trg = os.path.join(trg_dir, filename)
-                print("trg=", trg)
-                action = CopyAction(src, trg)
-
-                action.pre_commit()
-                assert os.path.exists(src)
-                assert os.path.exists(trg)
-
-                action.rollback()
-                assert os.path.exists(src)
-                assert not os.path.exists(trg)
-            finally:
-                os.remove(src)
+    def test_can_commit(self, tmp_path, src):
+        trg = str(tmp_path / "trg" / "src.txt")
+        action = CopyAction(src, trg)
+
+        action.pre_commit()
+        assert os.path.exists(src)
+        assert os.path.exists(trg)
+
+        action.commit()
+        assert os.path.exists(src)
+        with open(trg) as f:
+            assert f.read() == "contents"
+
+    def test_can_rollback(self, tmp_path, src):
+        trg = str(tmp_path / "trg" / "src.txt")
+        action = CopyAction(src, trg)
+
+        action.pre_commit()
+        assert os.path.exists(src)
+        assert os.path.exists(trg)
+
+        action.rollback()
+        assert os.path.exists(src)
+        assert not os.path.exists(trg)
+
+    def test_does_not_overwrite_or_remove_existing_target(self, tmp_path, src):
+        trg = tmp_path / "trg.txt"
+        trg.write_text("existing")
+        action = CopyAction(src, str(trg))
+        with pytest.raises(FileExistsError) as e:
+            action.pre_commit()
+        # reported as is, not as error raised while handling the one from open()
+        assert e.value.__suppress_context__
+        action.rollback()
+        assert trg.read_text() == "existing"
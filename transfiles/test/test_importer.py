@@ -1,8 +1,29 @@
 import datetime
 import os.path
+from concurrent.futures import ThreadPoolExecutor
 
+import piexif
+
+from transfiles import importer
 from transfiles.actions import MoveAction
-from transfiles.importer import parse_exif_date, ImportRawsActionsGenerator
+from transfiles.importer import parse_exif_date, ImportRawsActionsGenerator, find_date_taken_fast, \
+    find_date_taken_from_exif, CachedDateTaken, walk, is_raw_file, read_date_time_original, \
+    default_exif_dates_db
+
+
+def test_walk_is_same_as_os_walk(tmp_path):
+    (tmp_path / "a" / "b").mkdir(parents=True)
+    (tmp_path / "a" / "x.NEF").write_bytes(b"")
+    (tmp_path / "a" / "b" / "y.NEF").write_bytes(b"")
+    normalize = lambda walked: sorted((root, sorted(dirs), sorted(files)) for root, dirs, files in walked)
+    assert normalize(walk(str(tmp_path))) == normalize(os.walk(str(tmp_path)))
+
+
+def test_is_raw_file():
+    assert is_raw_file("a.NEF")
+    assert is_raw_file("a.Dng")
+    assert not is_raw_file("a.NEF.xmp")
+    assert not is_raw_file("nef")
 
 
 class TestParseDate:
@@ -11,6 +32,98 @@ class TestParseDate:
         dt = parse_exif_date(str_dt)
         assert dt == datetime.datetime(2020, 3, 22, 15, 35, 59)
 
+    def test_parse_exif_date_with_nonstandard_layout(self):
+        dt = parse_exif_date(b"2020:3:22 15:35:59")
+        assert dt == datetime.datetime(2020, 3, 22, 15, 35, 59)
+
+
+class TestFindDateTaken:
+    @staticmethod
+    def write_tiff(path, byte_order):
+        exif = piexif.dump({"0th": {piexif.ImageIFD.Make: b"NIKON"},
+                            "Exif": {piexif.ExifIFD.DateTimeOriginal: b"2020:03:22 15:35:59"}})
+        tiff = exif[len(b"Exif\x00\x00"):]
+        if byte_order == "II":
+            # piexif dumps big-endian only, so little-endian one is made by hand from the same values
+            tiff = TestFindDateTaken.little_endian_tiff(2, 20, (44).to_bytes(4, "little"), b"2020:03:22 15:35:59\x00")
+        with open(path, "wb") as f:
+            f.write(tiff)
+
+    @staticmethod
+    def little_endian_tiff(date_type: int, date_count: int, date_value: bytes, data: bytes) -> bytes:
+        """tiff with IFD0 having just Exif IFD pointer and Exif IFD having just DateTimeOriginal entry
+        with given fields, followed by data at offset 44"""
+        return (b"II" + (42).to_bytes(2, "little") + (8).to_bytes(4, "little") +
+                (1).to_bytes(2, "little") +
+                (0x8769).to_bytes(2, "little") + (4).to_bytes(2, "little") + (1).to_bytes(4, "little") +
+                (26).to_bytes(4, "little") + (0).to_bytes(4, "little") +
+                (1).to_bytes(2, "little") +
+                (0x9003).to_bytes(2, "little") + date_type.to_bytes(2, "little") + date_count.to_bytes(4, "little") +
+                date_value + (0).to_bytes(4, "little") +
+                data)
+
+    def test_reads_big_endian_tiff(self, tmp_path):
+        path = str(tmp_path / "a.NEF")
+        self.write_tiff(path, "MM")
+        assert find_date_taken_fast(path) == datetime.datetime(2020, 3, 22, 15, 35, 59)
+        assert find_date_taken_fast(path) == find_date_taken_from_exif(path)
+
+    def test_reads_little_endian_tiff(self, tmp_path):
+        path = str(tmp_path / "a.NEF")
+        self.write_tiff(path, "II")
+        assert find_date_taken_fast(path) == datetime.datetime(2020, 3, 22, 15, 35, 59)
+        assert find_date_taken_fast(path) == find_date_taken_from_exif(path)
+
+    def test_skips_date_not_stored_as_long_ascii(self, tmp_path):
+        path = tmp_path / "a.NEF"
+        # short ascii value is inline in the entry
+        path.write_bytes(self.little_endian_tiff(2, 4, b"202\x00", b""))
+        assert read_date_time_original(str(path)) is None
+        # non-ascii value pointing to where a date could be
+        path.write_bytes(self.little_endian_tiff(7, 20, (44).to_bytes(4, "little"), b"2020:03:22 15:35:59\x00"))
+        assert read_date_time_original(str(path)) is None
+
+    def test_falls_back_to_piexif_on_unparseable_date(self, tmp_path, monkeypatch):
+        path = str(tmp_path / "a.NEF")
+        self.write_tiff(path, "MM")
+        monkeypatch.setattr(importer, "read_date_time_original", lambda fname: b"2020:03:22 xx:35:59")
+        assert find_date_taken_fast(path) == datetime.datetime(2020, 3, 22, 15, 35, 59)
+
+    def test_falls_back_to_piexif_on_date_not_stored_as_long_ascii(self, tmp_path, monkeypatch):
+        path = str(tmp_path / "a.NEF")
+        self.write_tiff(path, "MM")
+        monkeypatch.setattr(importer, "read_date_time_original", lambda fname: None)
+        assert find_date_taken_fast(path) == datetime.datetime(2020, 3, 22, 15, 35, 59)
+
+
+class TestCachedDateTaken:
+    def test_reads_file_only_once_until_it_changes(self, tmp_path):
+        raw_file = tmp_path / "a.NEF"
+        raw_file.write_bytes(b"raw")
+        calls = []
+
+        def find_date_taken(fname):
+            calls.append(fname)
+            return datetime.datetime(2020, 3, 22, 15, 35, 59)
+
+        db_path = str(tmp_path / "cache" / "exif_dates.db")
+        with CachedDateTaken(find_date_taken, db_path) as subj:
+            assert subj(str(raw_file)) == datetime.datetime(2020, 3, 22, 15, 35, 59)
+        # cache survives reopening, as on rerun of the importer
+        with CachedDateTaken(find_date_taken, db_path) as subj:
+            assert subj(str(raw_file)) == datetime.datetime(2020, 3, 22, 15, 35, 59)
+            assert len(calls) == 1
+            raw_file.write_bytes(b"changed raw")
+            subj(str(raw_file))
+            assert len(calls) == 2
+
+    def test_default_db_follows_xdg(self, monkeypatch):
+        monkeypatch.setenv("HOME", "/home/user")
+        monkeypatch.setenv("XDG_CACHE_HOME", "/cache_home")
+        assert default_exif_dates_db() == os.path.join("/cache_home", "transfiles", "exif_dates.db")
+        monkeypatch.setenv("XDG_CACHE_HOME", "relative_cache_home")
+        assert default_exif_dates_db() == os.path.join("/home/user", ".cache", "transfiles", "exif_dates.db")
+
 
 class TestImportRawsActionsGenerator:
     def test_generate(self):
@@ -28,3 +141,31 @@ class TestImportRawsActionsGenerator:
             MoveAction(os.path.join(root, "b.xmp"), os.path.join(trg_dir, "2020", "2020-03-02", "b.xmp")),
             MoveAction(os.path.join(root, "c.NEF"), os.path.join(trg_dir, "2020", "2020-03-02", "c.NEF"))
         ]
+
+    def test_generate_in_parallel_keeps_order_and_skips_failed(self):
+        trg_dir = "/target"
+
+        def find_date_taken(fname):
+            if fname.endswith("b.NEF"):
+                raise ValueError("no exif")
+            return datetime.datetime(2020, 3, 2)
+
+        root = "/src"
+        files = ["a.NEF", "a.xmp", "b.NEF", "c.NEF"]
+        with ThreadPoolExecutor(max_workers=4) as executor:
+            subj = ImportRawsActionsGenerator(trg_dir, find_date_taken, delete_src=True, executor=executor)
+            actions = subj.generate(root, [], files)
+        assert actions == [
+            MoveAction(os.path.join(root, "a.NEF"), os.path.join(trg_dir, "2020", "2020-03-02", "a.NEF")),
+            MoveAction(os.path.join(root, "a.xmp"), os.path.join(trg_dir, "2020", "2020-03-02", "a.xmp")),
+            MoveAction(os.path.join(root, "c.NEF"), os.path.join(trg_dir, "2020", "2020-03-02", "c.NEF"))
+        ]
+
+    def test_generate_for_root_with_trailing_separator(self):
+        trg_dir = "/target"
+        find_date_taken = lambda fname: datetime.datetime(2020, 3, 2)
+        subj = ImportRawsActionsGenerator(trg_dir, find_date_taken, delete_src=True)
+        actions = subj.generate(os.path.join("/src", ""), [], ["a.NEF"])
+        assert actions == [
+            MoveAction(os.path.join("/src", "a.NEF"), os.path.join(trg_dir, "2020", "2020-03-02", "a.NEF"))
+        ]
@@ -5,6 +5,9 @@ logger = logging.getLogger(__name__)
 
 
 class Action:
+    # imports may create an action per file, so subclasses are better slotted too
+    __slots__ = ()
+
     def pre_commit(self):
         """Do some action on file, in durable but revertible form (e.g. if your
         action is deleting a file, don't delete it here but just rename to some
@@ -1,3 +1,4 @@
+"""Helpers for grouping collections and splitting file names into base name and extension"""
 import collections
 
 from typing import Iterable, Callable, TypeVar, Mapping